@@ -1,12 +1,20 @@
 import os
+import asyncio
+import base64
+import hmac
 import logging
-from datetime import datetime, timedelta, time as dtime
+from datetime import date, datetime, timedelta, time as dtime
 from typing import Dict, List, Optional
+from dataclasses import dataclass, field
+from functools import lru_cache
+from itertools import accumulate
+from bisect import bisect_left
 import re
-import smtplib
-from email.mime.text import MIMEText
-from difflib import SequenceMatcher
+import sys
+import time
+import unicodedata
 from pathlib import Path
+from zoneinfo import ZoneInfo
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.constants import ChatAction
@@ -19,17 +27,22 @@ from telegram.ext import (
     filters,
     ContextTypes,
     AIORateLimiter,
+    BaseUpdateProcessor,
 )
+import httpx
+import orjson
 from dotenv import load_dotenv
-import pytz
+from rapidfuzz import fuzz, process
+from sqlalchemy import DateTime, exists, func, insert, select, type_coerce
+from sqlalchemy.exc import IntegrityError
 
 # Import database models and services
 from database.appointments_db import (
-    User, Appointment, init_db as init_appt_db, get_db as get_appt_db,
-    UserType, AppointmentStatus, SessionLocal as ApptSession
+    User, Appointment, init_db as init_appt_db,
+    UserType, AppointmentStatus, session_scope as appt_session
 )
 from database.questions_db import (
-    FAQ, UserQuestion, Feedback, init_db as init_q_db, seed_faqs, SessionLocal as QuestionsSession
+    FAQ, UserQuestion, Feedback, init_db as init_q_db, seed_faqs, session_scope as questions_session
 )
 from services.voice_handler import VoiceHandler
 
@@ -62,6 +75,7 @@ voice_handler = VoiceHandler()
 
 # Settings
 TIMEZONE = os.getenv('TIMEZONE', 'America/Caracas')
+_TZ = ZoneInfo(TIMEZONE)
 PRICE_PERSONA_NATURAL = os.getenv('PRICE_PERSONA_NATURAL', '').strip()
 PRICE_PERSONA_JURIDICA = os.getenv('PRICE_PERSONA_JURIDICA', '').strip()
 PRICE_RENOVACION = os.getenv('PRICE_RENOVACION', '').strip()
@@ -71,15 +85,63 @@ BUSINESS_HOURS_START = int(os.getenv('BUSINESS_HOURS_START', '8'))
 BUSINESS_HOURS_END = int(os.getenv('BUSINESS_HOURS_END', '17'))
 # Mailer microservicio (PHPMailer vía HTTP)
 MAILER_URL = os.getenv('MAILER_URL', 'http://mailer')
+# 3s to connect, 10s per read: a stalled mailer must not hold a send task for long
+MAILER_TIMEOUT = httpx.Timeout(10, connect=3)
+# Shared async client: pooled keep-alive connections to the mailer, closed in drain_background_tasks.
+# The transport retries failed connects only (never a sent request), so a retry can't duplicate an email
+_MAILER = httpx.AsyncClient(
+    timeout=MAILER_TIMEOUT,
+    transport=httpx.AsyncHTTPTransport(
+        retries=2,
+        limits=httpx.Limits(max_connections=32, max_keepalive_connections=20),
+    ),
+)
 # QR signed URL config
 QR_BASE_URL = os.getenv('QR_BASE_URL', 'https://app.authenology.com.ve')
 QR_SECRET = os.getenv('QR_SECRET', '')
+_QR_SECRET_BYTES = QR_SECRET.encode('utf-8')
 EMAILJS_FROM = os.getenv('SMTP_FROM', os.getenv('MAIL_FROM', os.getenv('EMAILJS_FROM', 'no-reply@authenology.com.ve')))
+# Datos de contacto que van en los correos de cita
+BUSINESS_INFO = {
+    'location': 'Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
+    'support_phone': '0412-3379711',
+    'support_email': 'contacto@authenology.com.ve',
+}
 # Admin notify (comma-separated emails)
 ADMIN_NOTIFY_EMAILS = [e.strip() for e in os.getenv('ADMIN_NOTIFY_EMAILS', '').split(',') if e.strip()]
+# FAQ cache for free-text matching (seconds)
+FAQ_CACHE_TTL = int(os.getenv('FAQ_CACHE_TTL', '60'))
+_FAQ_CACHE = {'ts': float('-inf'), 'entry': ([], [], {}), 'by_cat': {}, 'by_id': {}, 'markups': {}}
+# Available-slot cache per date (seconds); entries are dropped as soon as an appointment is booked
+SLOTS_CACHE_TTL = int(os.getenv('SLOTS_CACHE_TTL', '15'))
+_SLOTS_CACHE = {}
+# Max distinct texts memoized by the intent routers and best_faq_answer
+INTENT_CACHE_SIZE = 4096
+# Strong references to fire-and-forget tasks so they are not garbage-collected mid-flight
+_background_tasks = set()
+# UserQuestion/Feedback rows waiting for the batched analytics writer
+ANALYTICS_FLUSH_SECONDS = 1.0
+ANALYTICS_BATCH_SIZE = 50
+_analytics_queue = asyncio.Queue()
+_analytics_task = None
+
+def _full_name(user) -> str:
+    return f"{user.first_name} {user.last_name or ''}".strip()
+
+# Nombres en español sin depender del locale del host (strftime('%A'/'%B') salía en inglés sin es_ES)
+_SPANISH_DAYS = ('lunes', 'martes', 'miércoles', 'jueves', 'viernes', 'sábado', 'domingo')
+_SPANISH_MONTHS = ('enero', 'febrero', 'marzo', 'abril', 'mayo', 'junio', 'julio', 'agosto',
+                   'septiembre', 'octubre', 'noviembre', 'diciembre')
+
+@lru_cache(maxsize=256)
+def format_appointment(dt: datetime) -> tuple:
+    """(fecha, hora) as shown in confirmations and emails; slots repeat, so confirm and save share one result."""
+    formatted_date = f"{_SPANISH_DAYS[dt.weekday()]}, {dt.day:02d} de {_SPANISH_MONTHS[dt.month - 1]} de {dt.year}"
+    formatted_time = f"{dt.hour % 12 or 12:02d}:{dt.minute:02d} {'PM' if dt.hour >= 12 else 'AM'}"
+    return formatted_date, formatted_time
 
 def get_tznow():
-    return datetime.now(pytz.timezone(TIMEZONE))
+    return datetime.now(_TZ)
 
 def support_blurb() -> str:
     return (
@@ -89,26 +151,17 @@ def support_blurb() -> str:
         "También puedo agendarte una cita si lo prefieres."
     )
 
-def build_confirmation_html(user_name: str, appointment_date: str, appointment_time: str,
-                            location: str, support_phone: str, support_email: str) -> str:
-    """Devuelve una plantilla HTML con estilo inline para máxima compatibilidad en clientes de correo."""
-    # Colores Authenology
-    primary = "#00bcd4"   # Cyan
-    accent = "#1de9b6"    # Teal/green accent
-    text = "#0a2540"
-    bg = "#f8fafc"
-    card = "#ffffff"
-    soft = "#e2f5f7"
-    soft2 = "#e0fcf7"
-
-    html = f"""
-    <div style="background:{bg}; padding:28px 12px;">
-      <div style="font-family:Arial,Helvetica,sans-serif; color:{text}; padding:0; border-radius:16px; max-width:620px; margin:auto; box-shadow:0 8px 28px rgba(10,37,64,0.08); overflow:hidden; background:#ffffff;">
+# HTML de correos con los colores Authenology ya aplicados: primary #00bcd4 (cyan), accent #1de9b6 (teal),
+# text #0a2540, bg #f8fafc, soft #e2f5f7, soft2 #e0fcf7. Se parten en literales una vez al importar;
+# por llamada solo se intercalan los datos de la cita con un "".join.
+_CONFIRMATION_TPL = """
+    <div style="background:#f8fafc; padding:28px 12px;">
+      <div style="font-family:Arial,Helvetica,sans-serif; color:#0a2540; padding:0; border-radius:16px; max-width:620px; margin:auto; box-shadow:0 8px 28px rgba(10,37,64,0.08); overflow:hidden; background:#ffffff;">
         <!-- Header / Hero -->
-        <div style="background:linear-gradient(135deg, {primary} 0%, {accent} 100%); padding:24px 20px; text-align:center;">
+        <div style="background:linear-gradient(135deg, #00bcd4 0%, #1de9b6 100%); padding:24px 20px; text-align:center;">
           <img src="https://app.authenology.com.ve/imagenes/logo01.png" alt="Authenology" style="width:84px;height:84px;margin-bottom:10px;border-radius:12px;background:#ffffff; padding:6px;">
           <h1 style="margin:6px 0 4px 0; font-size:22px; line-height:1.25; color:#ffffff; font-weight:800;">Confirmación de cita</h1>
-          <p style="margin:0; color:#eafffb; font-size:15px;">Hola {user_name}, tu cita ha sido agendada con éxito.</p>
+          <p style="margin:0; color:#eafffb; font-size:15px;">Hola $user_name, tu cita ha sido agendada con éxito.</p>
         </div>
 
         <!-- Intro copy -->
@@ -117,80 +170,114 @@ def build_confirmation_html(user_name: str, appointment_date: str, appointment_t
         </div>
 
         <!-- Appointment card -->
-        <div style="margin:0 22px 16px 22px; background:{soft2}; border:1px solid {soft}; border-radius:12px; padding:16px 18px;">
-          <div style="font-weight:700; color:{primary}; margin-bottom:8px;">Detalles de la cita</div>
-          <table role="presentation" cellpadding="0" cellspacing="0" width="100%" style="font-size:14px; color:{text};">
-            <tr><td style="padding:6px 0;"><strong>Fecha:</strong></td><td style="padding:6px 0;">{appointment_date}</td></tr>
-            <tr><td style="padding:6px 0;"><strong>Hora:</strong></td><td style="padding:6px 0;">{appointment_time}</td></tr>
-            <tr><td style="padding:6px 0;"><strong>Ubicación:</strong></td><td style="padding:6px 0;">{location}</td></tr>
+        <div style="margin:0 22px 16px 22px; background:#e0fcf7; border:1px solid #e2f5f7; border-radius:12px; padding:16px 18px;">
+          <div style="font-weight:700; color:#00bcd4; margin-bottom:8px;">Detalles de la cita</div>
+          <table role="presentation" cellpadding="0" cellspacing="0" width="100%" style="font-size:14px; color:#0a2540;">
+            <tr><td style="padding:6px 0;"><strong>Fecha:</strong></td><td style="padding:6px 0;">$appointment_date</td></tr>
+            <tr><td style="padding:6px 0;"><strong>Hora:</strong></td><td style="padding:6px 0;">$appointment_time</td></tr>
+            <tr><td style="padding:6px 0;"><strong>Ubicación:</strong></td><td style="padding:6px 0;">$location</td></tr>
           </table>
         </div>
 
         <!-- Primary CTA -->
         <div style="text-align:center; padding:0 22px 16px 22px;">
-          <a href="https://app.authenology.com.ve" style="display:inline-block; background:{primary}; color:#ffffff; text-decoration:none; font-weight:700; padding:12px 18px; border-radius:999px; box-shadow:0 6px 18px rgba(0,188,212,0.35);">Ir a mi panel</a>
+          <a href="https://app.authenology.com.ve" style="display:inline-block; background:#00bcd4; color:#ffffff; text-decoration:none; font-weight:700; padding:12px 18px; border-radius:999px; box-shadow:0 6px 18px rgba(0,188,212,0.35);">Ir a mi panel</a>
         </div>
 
         <!-- Contact card -->
-        <div style="margin:0 22px 16px 22px; background:#ffffff; border:1px solid {soft}; border-radius:12px; padding:14px 16px;">
-          <div style="font-weight:700; color:{primary};">Información de contacto</div>
-          <table role="presentation" cellpadding="0" cellspacing="0" width="100%" style="font-size:14px; color:{text}; margin-top:6px;">
-            <tr><td style="padding:6px 0;"><strong>Teléfono:</strong></td><td style="padding:6px 0;">{support_phone}</td></tr>
-            <tr><td style="padding:6px 0;"><strong>Correo:</strong></td><td style="padding:6px 0;"><a href="mailto:{support_email}" style="color:{accent}; text-decoration:underline;">{support_email}</a></td></tr>
+        <div style="margin:0 22px 16px 22px; background:#ffffff; border:1px solid #e2f5f7; border-radius:12px; padding:14px 16px;">
+          <div style="font-weight:700; color:#00bcd4;">Información de contacto</div>
+          <table role="presentation" cellpadding="0" cellspacing="0" width="100%" style="font-size:14px; color:#0a2540; margin-top:6px;">
+            <tr><td style="padding:6px 0;"><strong>Teléfono:</strong></td><td style="padding:6px 0;">$support_phone</td></tr>
+            <tr><td style="padding:6px 0;"><strong>Correo:</strong></td><td style="padding:6px 0;"><a href="mailto:$support_email" style="color:#1de9b6; text-decoration:underline;">$support_email</a></td></tr>
           </table>
         </div>
 
         <!-- Quick links -->
         <div style="padding:0 22px 20px 22px;">
-          <div style="font-weight:700; color:{primary}; margin-bottom:6px;">Accesos rápidos</div>
+          <div style="font-weight:700; color:#00bcd4; margin-bottom:6px;">Accesos rápidos</div>
           <div>
-            <a href="mailto:{support_email}" style="margin-right:14px; color:{accent}; text-decoration:underline;">Escribir a soporte</a>
-            <a href="https://wa.me/584123379711" style="margin-right:14px; color:{accent}; text-decoration:underline;">WhatsApp</a>
-            <a href="https://app.authenology.com.ve" style="color:{text}; text-decoration:none;">App Authenology</a>
+            <a href="mailto:$support_email" style="margin-right:14px; color:#1de9b6; text-decoration:underline;">Escribir a soporte</a>
+            <a href="https://wa.me/584123379711" style="margin-right:14px; color:#1de9b6; text-decoration:underline;">WhatsApp</a>
+            <a href="https://app.authenology.com.ve" style="color:#0a2540; text-decoration:none;">App Authenology</a>
           </div>
         </div>
 
         <!-- Footer -->
-        <div style="background:{bg}; padding:14px 18px; text-align:center; font-size:12px; color:#64748b;">
+        <div style="background:#f8fafc; padding:14px 18px; text-align:center; font-size:12px; color:#64748b;">
           Este mensaje fue generado automáticamente por Authenology. Gracias por confiar en nosotros.
         </div>
       </div>
     </div>
     """
-    return html
 
-def build_admin_notify_html(user_name: str, user_email: str, appointment_date: str, appointment_time: str,
-                            location: str) -> str:
-    primary = "#00bcd4"
-    text = "#0a2540"
-    bg = "#f8fafc"
-    soft = "#e2f5f7"
-    html = f"""
-    <div style="background:{bg}; padding:24px 12px;">
-      <div style="font-family:Arial,Helvetica,sans-serif; color:{text}; padding:0; border-radius:12px; max-width:640px; margin:auto; background:#ffffff; box-shadow:0 6px 24px rgba(10,37,64,0.08);">
-        <div style="padding:16px 18px; border-bottom:1px solid {soft};">
-          <h2 style="margin:0; font-size:18px; color:{primary};">Nueva cita agendada</h2>
+_ADMIN_NOTIFY_TPL = """
+    <div style="background:#f8fafc; padding:24px 12px;">
+      <div style="font-family:Arial,Helvetica,sans-serif; color:#0a2540; padding:0; border-radius:12px; max-width:640px; margin:auto; background:#ffffff; box-shadow:0 6px 24px rgba(10,37,64,0.08);">
+        <div style="padding:16px 18px; border-bottom:1px solid #e2f5f7;">
+          <h2 style="margin:0; font-size:18px; color:#00bcd4;">Nueva cita agendada</h2>
         </div>
         <div style="padding:16px 18px; font-size:14px;">
           <p style="margin:0 0 10px 0;">Se registró una nueva cita desde el chatbot.</p>
           <table role="presentation" cellpadding="0" cellspacing="0" style="width:100%;">
-            <tr><td style="padding:6px 0; width:160px;"><strong>Cliente:</strong></td><td style="padding:6px 0;">{user_name}</td></tr>
-            <tr><td style="padding:6px 0;"><strong>Email:</strong></td><td style="padding:6px 0;">{user_email}</td></tr>
-            <tr><td style="padding:6px 0;"><strong>Fecha:</strong></td><td style="padding:6px 0;">{appointment_date}</td></tr>
-            <tr><td style="padding:6px 0;"><strong>Hora:</strong></td><td style="padding:6px 0;">{appointment_time}</td></tr>
-            <tr><td style="padding:6px 0;"><strong>Ubicación:</strong></td><td style="padding:6px 0;">{location}</td></tr>
+            <tr><td style="padding:6px 0; width:160px;"><strong>Cliente:</strong></td><td style="padding:6px 0;">$user_name</td></tr>
+            <tr><td style="padding:6px 0;"><strong>Email:</strong></td><td style="padding:6px 0;">$user_email</td></tr>
+            <tr><td style="padding:6px 0;"><strong>Fecha:</strong></td><td style="padding:6px 0;">$appointment_date</td></tr>
+            <tr><td style="padding:6px 0;"><strong>Hora:</strong></td><td style="padding:6px 0;">$appointment_time</td></tr>
+            <tr><td style="padding:6px 0;"><strong>Ubicación:</strong></td><td style="padding:6px 0;">$location</td></tr>
           </table>
         </div>
       </div>
     </div>
     """
-    return html
 
-def notify_admin_appointment(to_list: List[str], user_name: str, user_email: str, formatted_date: str, formatted_time: str):
+
+def _split_template(tpl: str):
+    """Parte la plantilla en (literales, claves) una sola vez; literales[i] precede a claves[i]."""
+    pieces = re.split(r"\$(\w+)", tpl)
+    return tuple(pieces[0::2]), tuple(pieces[1::2])
+
+
+def _render_template(compiled, values: dict) -> str:
+    parts, keys = compiled
+    out = [parts[0]]
+    for key, literal in zip(keys, parts[1:]):
+        out.append(values[key])
+        out.append(literal)
+    return "".join(out)
+
+
+_CONFIRMATION_PARTS = _split_template(_CONFIRMATION_TPL)
+_ADMIN_NOTIFY_PARTS = _split_template(_ADMIN_NOTIFY_TPL)
+
+def build_confirmation_html(user_name: str, appointment_date: str, appointment_time: str,
+                            location: str, support_phone: str, support_email: str) -> str:
+    """Devuelve una plantilla HTML con estilo inline para máxima compatibilidad en clientes de correo."""
+    return _render_template(_CONFIRMATION_PARTS, {
+        'user_name': user_name,
+        'appointment_date': appointment_date,
+        'appointment_time': appointment_time,
+        'location': location,
+        'support_phone': support_phone,
+        'support_email': support_email,
+    })
+
+def build_admin_notify_html(user_name: str, user_email: str, appointment_date: str, appointment_time: str,
+                            location: str) -> str:
+    return _render_template(_ADMIN_NOTIFY_PARTS, {
+        'user_name': user_name,
+        'user_email': user_email,
+        'appointment_date': appointment_date,
+        'appointment_time': appointment_time,
+        'location': location,
+    })
+
+async def notify_admin_appointment(to_list: List[str], user_name: str, user_email: str, formatted_date: str,
+                                   formatted_time: str):
     if not to_list:
         return
     subject = "[Authenology] Nueva cita agendada"
-    location = 'Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda'
+    location = BUSINESS_INFO['location']
     body = (
         "Nueva cita registrada desde el chatbot.\n\n"
         f"Cliente: {user_name}\n"
@@ -200,59 +287,232 @@ def notify_admin_appointment(to_list: List[str], user_name: str, user_email: str
         f"Ubicación: {location}\n"
     )
     html = build_admin_notify_html(user_name, user_email, formatted_date, formatted_time, location)
+    # Un solo envío: primer admin en To y el resto en BCC
+    params = {'html': html, 'reply_to': user_email}
+    if len(to_list) > 1:
+        params['bcc'] = to_list[1:]
+    if await _deliver_mail(to_list[0], subject, body, params) is not False or len(to_list) == 1:
+        return
+    # Solo si el mailer rechazó el envío agrupado (no salió nada) volver a un correo por destinatario;
+    # tras un timeout o error SMTP el correo pudo haber salido y reenviarlo duplicaría avisos
     for admin_email in to_list:
-        try:
-            send_email_emailjs(admin_email, subject, body, {'html': html, 'reply_to': user_email})
-        except Exception:
-            pass
+        await send_email_emailjs(admin_email, subject, body, {'html': html, 'reply_to': user_email})
 
-def smalltalk_answer(text: str) -> Optional[str]:
+async def send_appointment_emails(user_email: str, user_name: str, formatted_date: str, formatted_time: str) -> None:
+    """Send the user's confirmation and the admin notifications through the shared mailer client."""
+    body = (
+        "Hola,\n\n"
+        f"Tu cita ha sido confirmada para el {formatted_date} a las {formatted_time}.\n\n"
+        f"Ubicación: {BUSINESS_INFO['location']}\n"
+        f"Teléfono: {BUSINESS_INFO['support_phone']}\n\n"
+        "Si necesitas reprogramar, responde a este correo.\n\n"
+        "Gracias."
+    )
+    html = build_confirmation_html(
+        user_name=user_name,
+        appointment_date=formatted_date,
+        appointment_time=formatted_time,
+        **BUSINESS_INFO,
+    )
+    await send_email_emailjs(user_email, "Confirmación de cita - Authenology", body, {
+        'appointment_date': formatted_date,
+        'appointment_time': formatted_time,
+        'user_name': user_name,
+        **BUSINESS_INFO,
+        'email_type': 'appointment_confirmation',
+        'html': html,
+    })
+    await notify_admin_appointment(
+        ADMIN_NOTIFY_EMAILS,
+        user_name=user_name,
+        user_email=user_email or 'sin-email',
+        formatted_date=formatted_date,
+        formatted_time=formatted_time,
+    )
+
+def _log_background_error(task: asyncio.Task) -> None:
+    _background_tasks.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error(f"Background task error: {task.exception()}")
+
+def send_appointment_emails_in_background(user_email: str, user_name: str, formatted_date: str, formatted_time: str) -> None:
+    """Fire-and-forget send_appointment_emails as a task so the handler replies without waiting on the mailer."""
+    task = asyncio.create_task(send_appointment_emails(user_email, user_name, formatted_date, formatted_time))
+    _background_tasks.add(task)
+    task.add_done_callback(_log_background_error)
+
+def log_analytics(model, **values) -> None:
+    """Queue a UserQuestion/Feedback row as column values; analytics_writer inserts them in batches off the event loop."""
+    _analytics_queue.put_nowait((model, values))
+
+def _write_analytics(batch: list) -> None:
+    # One Core executemany per model and column set: no ORM objects or unit of work for analytics rows
+    groups = {}
+    for model, values in batch:
+        groups.setdefault((model, tuple(values)), []).append(values)
+    try:
+        with questions_session() as qdb:
+            for (model, _), rows in groups.items():
+                qdb.execute(insert(model), rows)
+    except Exception as e:
+        logger.error(f"Analytics write failed ({len(batch)} rows): {e}")
+
+async def analytics_writer() -> None:
+    """Flush queued analytics every ANALYTICS_FLUSH_SECONDS or ANALYTICS_BATCH_SIZE rows, one commit per batch.
+
+    A None in the queue is the shutdown signal: the pending batch is written and the writer returns.
+    """
+    loop = asyncio.get_running_loop()
+    stop = False
+    while not stop:
+        row = await _analytics_queue.get()
+        if row is None:
+            return
+        batch = [row]
+        deadline = loop.time() + ANALYTICS_FLUSH_SECONDS
+        while len(batch) < ANALYTICS_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(_analytics_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stop = True
+                break
+            batch.append(row)
+        await asyncio.to_thread(_write_analytics, batch)
+
+async def start_background_workers(application) -> None:
+    global _analytics_task
+    _analytics_task = asyncio.create_task(analytics_writer())
+    # Load the (just seeded) FAQs now so the first user question doesn't pay for the DB read
+    await asyncio.to_thread(_get_faqs_cached)
+
+async def drain_background_tasks(application) -> None:
+    """On shutdown, let the analytics writer flush its last batch, wait for in-flight emails and close the mailer and calendar clients."""
+    if _analytics_task is not None:
+        _analytics_queue.put_nowait(None)
+        await asyncio.gather(_analytics_task, return_exceptions=True)
+    if _background_tasks:
+        await asyncio.gather(*_background_tasks, return_exceptions=True)
+    await _MAILER.aclose()
+    # The calendar service needs the optional Google libraries: close it only if something loaded it
+    calendar_service = sys.modules.get('services.calendar_service')
+    if calendar_service is not None:
+        await calendar_service.close_calendar_service()
+    # Rows queued while no writer was running
+    batch = []
+    while not _analytics_queue.empty():
+        row = _analytics_queue.get_nowait()
+        if row is not None:
+            batch.append(row)
+    if batch:
+        _write_analytics(batch)
+
+@dataclass(slots=True, frozen=True)
+class NormalizedMsg:
+    """User text lowercased and tokenized once per update, shared by the intent routers.
+
+    Equality and hashing use only `low`, so it works as a cache key for the routers; `low` is
+    NFC-normalized with whitespace collapsed, so spacing/accent-encoding variants share one entry.
+    """
+    raw: str = field(compare=False)
+    low: str
+    tokens: frozenset[str] = field(compare=False)
+
+def normalize_msg(text: str) -> NormalizedMsg:
+    raw = text or ''
+    low = ' '.join(unicodedata.normalize('NFC', raw).lower().split())
+    return NormalizedMsg(raw, low, frozenset(t for t in low.split() if len(t) > 2))
+
+_SMALLTALK_OK_SET = frozenset({'ok', 'okey', 'vale', 'listo', 'perfecto', 'entendido'})
+# Substring cues (like the old lists): 'grac' covers every 'gracias' variant, 'buenas' covers tardes/noches
+_SMALLTALK_RE = re.compile(
+    r'(?P<thanks>grac)'
+    r'|(?P<ok>ok|vale|listo|perfecto|entendido)'
+    r'|(?P<greet>hola|buenos d[ií]as|buenas)'
+    r'|(?P<bye>adi[oó]s|chao|hasta luego|nos vemos)'
+)
+_SMALLTALK_PRIORITY = ('thanks', 'ok', 'greet', 'bye')
+_SMALLTALK_REPLIES = {
+    'thanks': "¡Con gusto! ¿Necesitas algo más?",
+    'ok': "Perfecto. Si quieres, puedo agendar una cita o mostrarte los precios.",
+    'greet': "¡Hola! ¿Sobre qué te gustaría saber? Precios, citas o contacto están a un clic.",
+    'bye': "¡Hasta luego! Cuando necesites, estaré aquí para ayudarte.",
+}
+
+@lru_cache(maxsize=INTENT_CACHE_SIZE)
+def smalltalk_answer(msg: NormalizedMsg) -> Optional[str]:
     """Handle simple courtesy/ack phrases like 'gracias', 'ok', 'listo'."""
-    if not text:
+    if not msg.low:
         return None
-    t = text.lower().strip()
-    thanks = ['gracias', 'muchas gracias', 'gracias!', 'gracias.', 'gracias!!', 'grac']
-    oks = ['ok', 'okey', 'vale', 'listo', 'perfecto', 'entendido']
-    greets = ['hola', 'buenos dias', 'buenos días', 'buenas', 'buenas tardes', 'buenas noches']
-    byes = ['adios', 'adiós', 'chao', 'hasta luego', 'nos vemos']
-    if any(x in t for x in thanks):
-        return "¡Con gusto! ¿Necesitas algo más?"
-    if any(x == t or x in t for x in oks):
-        return "Perfecto. Si quieres, puedo agendar una cita o mostrarte los precios."
-    if any(x in t for x in greets):
-        return "¡Hola! ¿Sobre qué te gustaría saber? Precios, citas o contacto están a un clic."
-    if any(x in t for x in byes):
-        return "¡Hasta luego! Cuando necesites, estaré aquí para ayudarte."
-    return None
+    t = msg.low.strip()
+    if t in _SMALLTALK_OK_SET:
+        return _SMALLTALK_REPLIES['ok']
+    found = {m.lastgroup for m in _SMALLTALK_RE.finditer(t)}
+    intent = next((k for k in _SMALLTALK_PRIORITY if k in found), None)
+    return _SMALLTALK_REPLIES[intent] if intent else None
+
+# Static inline keyboards shared by every response (PTB markups are immutable)
+_SUPPORT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Agendar cita", callback_data="schedule_appt")],
+    [InlineKeyboardButton("❓ Ver FAQs", callback_data="back_to_categories")],
+    [InlineKeyboardButton("📞 Contacto", callback_data="contact_info")],
+])
+_FEEDBACK_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("👍 Útil", callback_data="fb_up"),
+        InlineKeyboardButton("👎 No útil", callback_data="fb_down"),
+    ]
+])
+_SUGGESTIONS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💳 Precios", callback_data="back_to_categories")],
+    [InlineKeyboardButton("📅 Agendar cita", callback_data="schedule_appt")],
+    [InlineKeyboardButton("📞 Contacto", callback_data="contact_info")],
+])
+_MAIN_MENU_MARKUP = ReplyKeyboardMarkup([
+    ["📅 Agendar cita"],
+    ["❓ Preguntas frecuentes", "📞 Contacto"],
+    ["ℹ️ Acerca de Authenology"],
+], resize_keyboard=True)
+_CONFIRM_APPT_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("✅ Confirmar", callback_data="confirm_appt"),
+        InlineKeyboardButton("❌ Cancelar", callback_data="cancel_appt"),
+    ]
+])
 
 def support_markup() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("📅 Agendar cita", callback_data="schedule_appt")],
-        [InlineKeyboardButton("❓ Ver FAQs", callback_data="back_to_categories")],
-        [InlineKeyboardButton("📞 Contacto", callback_data="contact_info")],
-    ])
+    return _SUPPORT_MARKUP
 
-def feedback_markup() -> InlineKeyboardMarkup:
+@lru_cache(maxsize=256)
+def _faq_feedback_markup(faq_id: int) -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
         [
-            InlineKeyboardButton("👍 Útil", callback_data="fb_up"),
-            InlineKeyboardButton("👎 No útil", callback_data="fb_down"),
+            InlineKeyboardButton("👍 Útil", callback_data=f"fb_up:{faq_id}"),
+            InlineKeyboardButton("👎 No útil", callback_data=f"fb_down:{faq_id}"),
         ]
     ])
 
+def feedback_markup(faq_id: Optional[int] = None) -> InlineKeyboardMarkup:
+    """Thumbs up/down keyboard; with faq_id the vote is recorded against that FAQ."""
+    if faq_id is None:
+        return _FEEDBACK_MARKUP
+    return _faq_feedback_markup(faq_id)
+
 def suggestions_markup() -> InlineKeyboardMarkup:
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton("💳 Precios", callback_data="back_to_categories")],
-        [InlineKeyboardButton("📅 Agendar cita", callback_data="schedule_appt")],
-        [InlineKeyboardButton("📞 Contacto", callback_data="contact_info")],
-    ])
+    return _SUGGESTIONS_MARKUP
 
 async def safe_send(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str, reply_markup=None, parse_mode: str = 'Markdown'):
     """Send a message safely whether the trigger was a message or a callback query."""
     try:
-        # show typing indicator briefly
+        # show typing indicator briefly, once per update (replies often take 2-3 messages)
         chat_id = update.effective_chat.id
-        await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+        if context.chat_data.get('_typing_update_id') != update.update_id:
+            context.chat_data['_typing_update_id'] = update.update_id
+            await context.bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
         if update.message:
             return await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=parse_mode, disable_web_page_preview=True)
         if update.callback_query:
@@ -268,75 +528,178 @@ async def safe_send(update: Update, context: ContextTypes.DEFAULT_TYPE, text: st
 def ensure_tz(dt: datetime) -> datetime:
     """Ensure a datetime is timezone-aware in configured TIMEZONE."""
     if dt.tzinfo is None:
-        return pytz.timezone(TIMEZONE).localize(dt)
-    return dt.astimezone(pytz.timezone(TIMEZONE))
+        return dt.replace(tzinfo=_TZ)
+    return dt.astimezone(_TZ)
 
-def best_faq_answer(query_text: str) -> Optional[FAQ]:
+def _get_faqs_cached() -> tuple:
+    """Return (rows, texts, memo) for active FAQs, reloading every FAQ_CACHE_TTL seconds.
+
+    rows: (faq, question_lower, answer_lower, question_tokens, answer_tokens) per FAQ.
+    texts: all lowercased questions followed by all lowercased answers, for batch fuzzy scoring.
+    memo: best_faq_answer results by normalized text; starts empty on every reload.
+    The same reload fills _FAQ_CACHE['by_cat'] and ['by_id'] for the FAQ browsing callbacks
+    and drops the per-category keyboards built from the previous rows.
+    """
+    now = time.monotonic()
+    # Gate on age only: an empty active set is cached too instead of hitting the DB per message
+    if now - _FAQ_CACHE['ts'] < FAQ_CACHE_TTL:
+        return _FAQ_CACHE['entry']
+    with questions_session() as qdb:
+        faqs = qdb.query(FAQ).filter(FAQ.is_active == True).all()
+    rows = []
+    for f in faqs:
+        q_text = str(f.question).lower()
+        a_text = str(f.answer).lower()
+        rows.append((f, q_text, a_text, set(q_text.split()), set(a_text.split())))
+    texts = [r[1] for r in rows] + [r[2] for r in rows]
+    entry = (rows, texts, {})
+    by_cat = {}
+    for f in faqs:
+        by_cat.setdefault(f.category, []).append(f)
+    _FAQ_CACHE['by_cat'] = by_cat
+    _FAQ_CACHE['by_id'] = {f.id: f for f in faqs}
+    _FAQ_CACHE['markups'] = {}
+    _FAQ_CACHE['entry'] = entry
+    _FAQ_CACHE['ts'] = now
+    return entry
+
+def get_faqs_by_category(category: str) -> List[FAQ]:
+    """Active FAQs of a category, served from the FAQ cache."""
+    _get_faqs_cached()
+    return _FAQ_CACHE['by_cat'].get(category, [])
+
+def faqs_markup(category: str) -> InlineKeyboardMarkup:
+    """Question buttons for a category, built once per FAQ cache reload."""
+    faqs = get_faqs_by_category(category)
+    markups = _FAQ_CACHE['markups']
+    if category not in markups:
+        keyboard = [
+            [InlineKeyboardButton(faq.question, callback_data=f"faq_{faq.id}")]
+            for faq in faqs
+        ]
+        keyboard.append([InlineKeyboardButton("🔙 Volver a categorías", callback_data="back_to_categories")])
+        markups[category] = InlineKeyboardMarkup(keyboard)
+    return markups[category]
+
+def get_faq_by_id(faq_id: int) -> Optional[FAQ]:
+    """FAQ by id from the cache; inactive FAQs (not cached) still come from the DB as before."""
+    _get_faqs_cached()
+    faq = _FAQ_CACHE['by_id'].get(faq_id)
+    if faq is None:
+        with questions_session() as qdb:
+            faq = qdb.query(FAQ).filter(FAQ.id == faq_id).first()
+    return faq
+
+def best_faq_answer(msg: NormalizedMsg) -> Optional[FAQ]:
     """Return the most relevant active FAQ combining token overlap and fuzzy similarity."""
-    if not query_text:
-        return None
-    text = query_text.lower()
-    tokens = {t for t in text.replace('\n', ' ').split() if len(t) > 2}
+    text, tokens = msg.low, msg.tokens
     if not tokens:
         return None
-    qdb = QuestionsSession()
-    try:
-        faqs = qdb.query(FAQ).filter(FAQ.is_active == True).all()
-        best, best_score = None, 0.0
-        for f in faqs:
-            q_text = str(f.question).lower()
-            a_text = str(f.answer).lower()
-            q_tokens = set(q_text.split())
-            a_tokens = set(a_text.split())
-            overlap = len(tokens & q_tokens) * 2 + len(tokens & a_tokens)
-            fuzzy_q = SequenceMatcher(None, text, q_text).ratio()
-            fuzzy_a = SequenceMatcher(None, text, a_text).ratio()
-            score = overlap + 3.0 * max(fuzzy_q, fuzzy_a)
-            if score > best_score:
-                best, best_score = f, score
-        # Minimum threshold to accept an answer
-        if best and best_score >= 3.0 or (best and SequenceMatcher(None, text, str(best.question).lower()).ratio() >= 0.35):
-            return best
-        return None
-    finally:
-        qdb.close()
-
-def pricing_answer(text: str) -> Optional[str]:
+    rows, texts, memo = _get_faqs_cached()
+    if text in memo:
+        return memo[text]
+    if len(memo) >= INTENT_CACHE_SIZE:
+        memo.clear()
+    n = len(rows)
+    # Una sola llamada en C puntúa todas las preguntas (índices < n) y respuestas (índices >= n)
+    fuzzy = [0.0] * len(texts)
+    for _, ratio, i in process.extract(text, texts, scorer=fuzz.ratio, limit=None):
+        fuzzy[i] = ratio / 100.0
+    best_i, best_score = None, 0.0
+    for i, (f, q_text, a_text, q_tokens, a_tokens) in enumerate(rows):
+        overlap = len(tokens & q_tokens) * 2 + len(tokens & a_tokens)
+        score = overlap + 3.0 * max(fuzzy[i], fuzzy[n + i])
+        if score > best_score:
+            best_i, best_score = i, score
+    # Minimum threshold to accept an answer
+    best = None
+    if best_i is not None and (best_score >= 3.0 or fuzzy[best_i] >= 0.35):
+        best = rows[best_i][0]
+    memo[text] = best
+    return best
+
+def _keywords_re(words: List[str]) -> re.Pattern:
+    """Compile a list of plain keywords into one substring-matching alternation."""
+    return re.compile('|'.join(map(re.escape, words)))
+
+_PRICE_TRIGGER_RE = _keywords_re([
+    'precio', 'precios', 'coste', 'costo', 'vale', 'cuesta', 'tarifa', 'tarifas', 'presupuesto', 'presupuestos',
+    'precio aproximado', 'cuanto vale', 'cuánto vale', 'cuanto cuesta', 'cuánto cuesta'
+])
+# One alternation per product; when several match, _PRODUCT_PRIORITY decides (same order as the old elif chain)
+_PRODUCT_RE = re.compile(
+    r'(?P<natural>persona natural|natural)'
+    r'|(?P<juridica>persona jur[ií]dica|empresa|jur[ií]dica)'
+    r'|(?P<renovacion>renovaci[oó]n)'
+    r'|(?P<token>token|dispositivo)'
+    r'|(?P<empresarial>empresarial|corporativo)'
+)
+_PRODUCT_PRIORITY = ('natural', 'juridica', 'renovacion', 'token', 'empresarial')
+_PRODUCT_INFO = {
+    'natural': ('💳 Precio de la firma electrónica para Persona Natural', PRICE_PERSONA_NATURAL),
+    'juridica': ('🏢 Precio de la firma electrónica para Persona Jurídica/Empresas', PRICE_PERSONA_JURIDICA),
+    'renovacion': ('♻️ Precio de renovación de firma/certificado', PRICE_RENOVACION),
+    'token': ('🔐 Precio de token/dispositivo criptográfico', PRICE_TOKEN),
+    'empresarial': ('🏢 Planes empresariales/corporativos', PRICE_EMPRESARIAL),
+}
+_SERVICES_CUES_RE = _keywords_re(['servicio', 'servicios', 'api', 'sdk', 'integración', 'integracion', 'empres', 'empresa', 'volumen'])
+_RENEWAL_CUES_RE = _keywords_re(['renovar', 'renovación', 'renovacion', 'renove', 'renovarse'])
+
+# Union of every intent cue: a miss means none of the intent routers can answer
+_INTENT_CUES_RE = re.compile('|'.join(
+    p.pattern for p in (_PRICE_TRIGGER_RE, _SERVICES_CUES_RE, _RENEWAL_CUES_RE, _SMALLTALK_RE)
+))
+
+def has_intent_cue(msg: NormalizedMsg) -> bool:
+    """Cheap pre-check before running pricing/smalltalk/services/renewal routers."""
+    return _INTENT_CUES_RE.search(msg.low) is not None
+
+# Voice intents in router order; the lookahead reports overlapping cues and, on a shared start
+# ('vale'), the earlier group wins, so the highest-priority intent present is always found
+_VOICE_INTENT_RE = re.compile('(?=' + '|'.join(
+    f'(?P<{name}>{p.pattern})'
+    for name, p in (('price', _PRICE_TRIGGER_RE), ('services', _SERVICES_CUES_RE), ('renewal', _RENEWAL_CUES_RE))
+) + ')')
+_VOICE_INTENT_PRIORITY = ('price', 'services', 'renewal')
+
+def voice_intent(msg: NormalizedMsg) -> Optional[str]:
+    """Return the first router (price/services/renewal) whose cue appears in the text, in one regex pass."""
+    found = {m.lastgroup for m in _VOICE_INTENT_RE.finditer(msg.low)}
+    return next((k for k in _VOICE_INTENT_PRIORITY if k in found), None)
+
+# Menu keywords; the lookahead lets finditer report every keyword even when two of them overlap
+_MENU_RE = re.compile(
+    r'(?=(?P<schedule>agendar|cita)'
+    r'|(?P<faq>pregunta|faq)'
+    r'|(?P<contact>contacto|ayuda)'
+    r'|(?P<about>acerca|authenology))'
+)
+_MENU_PRIORITY = ('schedule', 'faq', 'contact', 'about')
+_APPOINTMENT_CUES_RE = _keywords_re(['agendar', 'agenda', 'agendame', 'agéndame', 'cita', 'reservar', 'programar'])
+_CONFIRM_CUES_RE = _keywords_re(['confirmar', 'sí', 'si', 'listo', 'ok'])
+_CANCEL_CUES_RE = _keywords_re(['cancelar', 'no', 'anular', 'cancel'])
+
+def menu_intent(text: str) -> Optional[str]:
+    """Return the menu option named in the text (schedule/faq/contact/about), in one regex pass."""
+    found = {m.lastgroup for m in _MENU_RE.finditer(text)}
+    return next((k for k in _MENU_PRIORITY if k in found), None)
+
+@lru_cache(maxsize=INTENT_CACHE_SIZE)
+def pricing_answer(msg: NormalizedMsg) -> Optional[str]:
     """Detect pricing intent for multiple products and build a rich answer."""
-    if not text:
+    t = msg.low
+    if not t:
         return None
-    t = text.lower()
-    triggers = [
-        'precio', 'precios', 'coste', 'costo', 'vale', 'cuesta', 'tarifa', 'tarifas', 'presupuesto', 'presupuestos',
-        'precio aproximado', 'cuanto vale', 'cuánto vale', 'cuanto cuesta', 'cuánto cuesta'
-    ]
-    if not any(w in t for w in triggers):
+    if not _PRICE_TRIGGER_RE.search(t):
         return None
 
-    product = None
+    found = {m.lastgroup for m in _PRODUCT_RE.finditer(t)}
+    product = next((p for p in _PRODUCT_PRIORITY if p in found), None)
     title = None
     price_line = None
-
-    if 'persona natural' in t or 'natural' in t:
-        product = 'natural'
-        title = '💳 Precio de la firma electrónica para Persona Natural'
-        price_line = f"Precio: {PRICE_PERSONA_NATURAL}" if PRICE_PERSONA_NATURAL else "Precio: contáctanos para la cotización actualizada."
-    elif 'persona juridica' in t or 'persona jurídica' in t or 'empresa' in t or 'juridica' in t or 'jurídica' in t:
-        product = 'juridica'
-        title = '🏢 Precio de la firma electrónica para Persona Jurídica/Empresas'
-        price_line = f"Precio: {PRICE_PERSONA_JURIDICA}" if PRICE_PERSONA_JURIDICA else "Precio: contáctanos para la cotización actualizada."
-    elif 'renovación' in t or 'renovacion' in t:
-        product = 'renovacion'
-        title = '♻️ Precio de renovación de firma/certificado'
-        price_line = f"Precio: {PRICE_RENOVACION}" if PRICE_RENOVACION else "Precio: contáctanos para la cotización actualizada."
-    elif 'token' in t or 'dispositivo' in t:
-        product = 'token'
-        title = '🔐 Precio de token/dispositivo criptográfico'
-        price_line = f"Precio: {PRICE_TOKEN}" if PRICE_TOKEN else "Precio: contáctanos para la cotización actualizada."
-    elif 'empresarial' in t or 'corporativo' in t or 'plan empresa' in t:
-        product = 'empresarial'
-        title = '🏢 Planes empresariales/corporativos'
-        price_line = f"Precio: {PRICE_EMPRESARIAL}" if PRICE_EMPRESARIAL else "Precio: contáctanos para la cotización actualizada."
+    if product:
+        title, price = _PRODUCT_INFO[product]
+        price_line = f"Precio: {price}" if price else "Precio: contáctanos para la cotización actualizada."
 
     if not product:
         # No product specified: return a concise summary with all available prices
@@ -382,13 +745,13 @@ def pricing_answer(text: str) -> Optional[str]:
     )
     return f"{title}\n\n{price_line}{common}"
 
-def services_answer(text: str) -> Optional[str]:
+@lru_cache(maxsize=INTENT_CACHE_SIZE)
+def services_answer(msg: NormalizedMsg) -> Optional[str]:
     """Detect queries about services (API/SDK/Empresarial)."""
-    if not text:
+    t = msg.low
+    if not t:
         return None
-    t = text.lower()
-    cues = ['servicio', 'servicios', 'api', 'sdk', 'integración', 'integracion', 'empres', 'empresa', 'volumen']
-    if not any(c in t for c in cues):
+    if not _SERVICES_CUES_RE.search(t):
         return None
     return (
         "🧩 Servicios disponibles\n\n"
@@ -398,13 +761,13 @@ def services_answer(text: str) -> Optional[str]:
         "¿Te interesa una integración o un plan por volumen? Puedo agendarte una reunión técnica o ponerte en contacto con nuestro equipo."
     )
 
-def renewal_info_answer(text: str) -> Optional[str]:
+@lru_cache(maxsize=INTENT_CACHE_SIZE)
+def renewal_info_answer(msg: NormalizedMsg) -> Optional[str]:
     """Detect informational queries about renewing the certificate."""
-    if not text:
+    t = msg.low
+    if not t:
         return None
-    t = text.lower()
-    cues = ['renovar', 'renovación', 'renovacion', 'renove', 'renovarse']
-    if not any(c in t for c in cues):
+    if not _RENEWAL_CUES_RE.search(t):
         return None
     return (
         "♻️ Renovación del Certificado Electrónico\n\n"
@@ -427,10 +790,9 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     user_id, username, first_name, last_name = get_user_info(update)
     
     # Create or update user in database (appointments DB)
-    db = ApptSession()
-    try:
-        user = db.query(User).filter(User.telegram_id == user_id).first()
-        if not user:
+    with appt_session() as db:
+        # Existence check only: select the id instead of hydrating the whole User
+        if db.execute(select(User.id).where(User.telegram_id == user_id)).first() is None:
             user = User(
                 telegram_id=user_id,
                 username=username,
@@ -439,9 +801,6 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
                 user_type=UserType.CUSTOMER,
             )
             db.add(user)
-            db.commit()
-    finally:
-        db.close()
     
     # Welcome message
     welcome_text = (
@@ -450,21 +809,36 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "¿En qué puedo ayudarte hoy?"
     )
     
-    # Create keyboard
-    keyboard = [
-        ["📅 Agendar cita"],
-        ["❓ Preguntas frecuentes", "📞 Contacto"],
-        ["ℹ️ Acerca de Authenology"]
-    ]
-    reply_markup = ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
-    
-    await safe_send(update, context, welcome_text, reply_markup=reply_markup, parse_mode='Markdown')
+    await safe_send(update, context, welcome_text, reply_markup=_MAIN_MENU_MARKUP, parse_mode='Markdown')
     # quick suggestions
     await safe_send(update, context, "Puedo ayudarte con precios, citas, contacto y más.", reply_markup=suggestions_markup())
     # mark current state
     context.user_data['current_state'] = 'HANDLE_MENU'
     return HANDLE_MENU
 
+async def announce_booking(update: Update, context: ContextTypes.DEFAULT_TYPE, user, appt_time: datetime,
+                           title: str = "✅ *¡Cita confirmada!*",
+                           footer: str = "Te enviaremos un recordatorio antes de tu cita.",
+                           reply_markup=None, edit=None) -> None:
+    """Tell the user the booking is confirmed (new message, or `edit` for callback flows) and queue the emails."""
+    formatted_date, formatted_time = format_appointment(appt_time)
+    text = (
+        f"{title}\n\n"
+        f"*Fecha:* {formatted_date}\n"
+        f"*Hora:* {formatted_time}\n\n"
+        f"{footer}"
+    )
+    if edit is not None:
+        await edit(text, parse_mode='Markdown')
+    else:
+        await safe_send(update, context, text, reply_markup=reply_markup, parse_mode='Markdown')
+    send_appointment_emails_in_background(
+        user.email,
+        user_name=_full_name(user),
+        formatted_date=formatted_date,
+        formatted_time=formatted_time,
+    )
+
 async def handle_email_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Collect and save user's email, then create appointment and email confirmation."""
     email = (update.message.text or '').strip()
@@ -472,8 +846,7 @@ async def handle_email_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await safe_send(update, context, "El correo no parece válido. Por favor, envíame un correo válido (ej: nombre@dominio.com).")
         return COLLECT_EMAIL
 
-    db = ApptSession()
-    try:
+    with appt_session() as db:
         user = db.query(User).filter(User.telegram_id == update.effective_user.id).first()
         if not user:
             await safe_send(update, context, "No pude encontrar tu usuario. Envía /start para reiniciar.")
@@ -486,69 +859,14 @@ async def handle_email_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
             await safe_send(update, context, "No tengo el horario de la cita. Por favor intenta agendar nuevamente.")
             return HANDLE_MENU
         # Ensure availability again and save
-        if not is_slot_available(appointment_time, appointment_time + timedelta(minutes=30)):
+        appt = book_slot(db, user, appointment_time)
+        if appt is None:
             await safe_send(update, context, "El horario seleccionado ya no está disponible. Intenta con otro horario.")
             return HANDLE_MENU
 
-        appt = Appointment(
-            user_id=user.id,
-            appointment_date=appointment_time,
-            duration_minutes=30,
-            status=AppointmentStatus.CONFIRMED
-        )
-        db.add(appt)
-        db.commit()
-
-        formatted_date = appointment_time.strftime('%A, %d de %B de %Y')
-        formatted_time = appointment_time.strftime('%I:%M %p')
-
-        await safe_send(update, context,
-            "✅ *¡Cita confirmada!*\n\n"
-            f"*Fecha:* {formatted_date}\n"
-            f"*Hora:* {formatted_time}\n\n"
-            "Te he enviado un correo de confirmación.",
-            reply_markup=support_markup(),
-            parse_mode='Markdown')
-
-        # Send email via mailer
-        try:
-            body = (
-                "Hola,\n\n"
-                f"Tu cita ha sido confirmada para el {formatted_date} a las {formatted_time}.\n\n"
-                "Ubicación: Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda\n"
-                "Teléfono: 0412-3379711\n\n"
-                "Si necesitas reprogramar, responde a este correo.\n\n"
-                "Gracias."
-            )
-            html = build_confirmation_html(
-                user_name=f"{user.first_name} {user.last_name or ''}".strip(),
-                appointment_date=formatted_date,
-                appointment_time=formatted_time,
-                location='Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
-                support_phone='0412-3379711',
-                support_email='contacto@authenology.com.ve',
-            )
-            send_email_emailjs(user.email, "Confirmación de cita - Authenology", body, {
-                'appointment_date': formatted_date,
-                'appointment_time': formatted_time,
-                'user_name': f"{user.first_name} {user.last_name or ''}".strip(),
-                'location': 'Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
-                'support_phone': '0412-3379711',
-                'support_email': 'contacto@authenology.com.ve',
-                'html': html,
-            })
-            # Notificar a administradores
-            notify_admin_appointment(
-                ADMIN_NOTIFY_EMAILS,
-                user_name=f"{user.first_name} {user.last_name or ''}".strip(),
-                user_email=user.email or 'sin-email',
-                formatted_date=formatted_date,
-                formatted_time=formatted_time,
-            )
-        except Exception:
-            pass
-    finally:
-        db.close()
+        await announce_booking(update, context, user, appointment_time,
+                               footer="Te he enviado un correo de confirmación.",
+                               reply_markup=support_markup())
 
     context.user_data.pop('await_email', None)
     return HANDLE_MENU
@@ -565,30 +883,26 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
         return context.user_data.get('current_state', HANDLE_MENU)
 
     # Guardar la pregunta de voz
-    qdb = QuestionsSession()
-    try:
-        uid, uname, fname, lname = get_user_info(update)
-        qdb.add(UserQuestion(
-            telegram_id=uid,
-            username=uname,
-            first_name=fname,
-            last_name=lname,
-            question_text=text,
-            source='voice'
-        ))
-        qdb.commit()
-    finally:
-        qdb.close()
+    uid, uname, fname, lname = get_user_info(update)
+    log_analytics(
+        UserQuestion,
+        telegram_id=uid,
+        username=uname,
+        first_name=fname,
+        last_name=lname,
+        question_text=text,
+        source='voice'
+    )
 
-    lt = text.lower()
+    msg = normalize_msg(text)
+    lt = msg.low
     # Confirmación/cancelación por voz si estamos en estado de confirmación
     if context.user_data.get('current_state') == 'CONFIRM_APPOINTMENT':
-        if any(w in lt for w in ['confirmar', 'sí', 'si', 'listo', 'ok']):
+        if _CONFIRM_CUES_RE.search(lt):
             # Reutilizar lógica de guardado similar a save_appointment() sin callback
             user_id = update.effective_user.id
-            db = next(get_appt_db())
-            try:
-                user = db.query(User).filter(User.telegram_id == user_id).first()
+            with appt_session() as db:
+                user = get_booking_user(db, user_id)
                 if not user:
                     await safe_send(update, context, "❌ Error: no encontré tu usuario. Envía /start para reiniciar.")
                     return HANDLE_MENU
@@ -600,143 +914,38 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
                     await safe_send(update, context, "✉️ Antes de confirmar, por favor escribe tu correo electrónico.")
                     context.user_data['await_email'] = True
                     return COLLECT_EMAIL
-                if not is_slot_available(appt_time, appt_time + timedelta(minutes=30)):
+                appointment = book_slot(db, user, appt_time)
+                if appointment is None:
                     await safe_send(update, context, "El horario ya no está disponible. Dime otra hora o día.")
                     return HANDLE_MENU
-                appointment = Appointment(
-                    user_id=user.id,
-                    appointment_date=appt_time,
-                    duration_minutes=30,
-                    status=AppointmentStatus.CONFIRMED
-                )
-                db.add(appointment)
-                db.commit()
-                formatted_date = appt_time.strftime('%A, %d de %B de %Y')
-                formatted_time = appt_time.strftime('%I:%M %p')
-                await safe_send(update, context,
-                    "✅ *¡Cita confirmada!*\n\n"
-                    f"*Fecha:* {formatted_date}\n"
-                    f"*Hora:* {formatted_time}\n\n"
-                    "Te enviaremos un recordatorio antes de tu cita.",
-                    parse_mode='Markdown')
-                try:
-                    body = (
-                        "Hola,\n\n"
-                        f"Tu cita ha sido confirmada para el {formatted_date} a las {formatted_time}.\n\n"
-                        "Ubicación: Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda\n"
-                        "Teléfono: 0412-3379711\n\n"
-                        "Si necesitas reprogramar, responde a este correo.\n\n"
-                        "Gracias."
-                    )
-                    html = build_confirmation_html(
-                        user_name=f"{user.first_name} {user.last_name or ''}".strip(),
-                        appointment_date=formatted_date,
-                        appointment_time=formatted_time,
-                        location='Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
-                        support_phone='0412-3379711',
-                        support_email='contacto@authenology.com.ve',
-                    )
-                    send_email_emailjs(user.email, "Confirmación de cita - Authenology", body, {
-                        'appointment_date': formatted_date,
-                        'appointment_time': formatted_time,
-                        'user_name': f"{user.first_name} {user.last_name or ''}".strip(),
-                        'location': 'Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
-                        'support_phone': '0412-3379711',
-                        'support_email': 'contacto@authenology.com.ve',
-                        'email_type': 'appointment_confirmation',
-                        'html': html,
-                    })
-                    notify_admin_appointment(
-                        ADMIN_NOTIFY_EMAILS,
-                        user_name=f"{user.first_name} {user.last_name or ''}".strip(),
-                        user_email=user.email or 'sin-email',
-                        formatted_date=formatted_date,
-                        formatted_time=formatted_time,
-                    )
-                except Exception:
-                    pass
+                await announce_booking(update, context, user, appt_time)
                 context.user_data['current_state'] = 'HANDLE_MENU'
                 return HANDLE_MENU
-            finally:
-                db.close()
-        if any(w in lt for w in ['cancelar', 'no', 'anular', 'cancel']):
+        if _CANCEL_CUES_RE.search(lt):
             await safe_send(update, context, "❌ Cita cancelada. Dime otro día para reintentar.")
             context.user_data['current_state'] = 'HANDLE_MENU'
             return HANDLE_MENU
 
     # Priorizar intención de agendar por voz y salto directo a fecha/hora
-    appointment_keywords = ['agendar', 'agenda', 'agendame', 'agéndame', 'cita', 'reservar', 'programar']
-    parsed_date = parse_spanish_date(lt)
-    parsed_time = parse_spanish_time(lt)
-    if any(k in lt for k in appointment_keywords) or parsed_date or parsed_time:
+    parsed_date = parse_spanish_date(msg)
+    parsed_time = parse_spanish_time(msg)
+    if _APPOINTMENT_CUES_RE.search(lt) or parsed_date or parsed_time:
         target_date = parsed_date or get_tznow().date() + timedelta(days=1)
         if parsed_time:
             slot = pick_best_slot_for_datetime(target_date, parsed_time[0], parsed_time[1])
             if slot:
                 # Auto-confirmar si ya tenemos email del usuario
                 user_id = update.effective_user.id
-                db = next(get_appt_db())
-                try:
-                    user = db.query(User).filter(User.telegram_id == user_id).first()
+                with appt_session() as db:
+                    user = get_booking_user(db, user_id)
                     if user and user.email:
                         appt_time = slot['start']
-                        if not is_slot_available(appt_time, appt_time + timedelta(minutes=30)):
+                        appointment = book_slot(db, user, appt_time)
+                        if appointment is None:
                             # Si justo se ocupó, mostrar horarios del día
                             await safe_send(update, context, "Ese horario acaba de ocuparse. Te muestro opciones disponibles para ese día:")
                             return await show_time_slots_for_date(update, context, target_date)
-                        appointment = Appointment(
-                            user_id=user.id,
-                            appointment_date=appt_time,
-                            duration_minutes=30,
-                            status=AppointmentStatus.CONFIRMED
-                        )
-                        db.add(appointment)
-                        db.commit()
-                        formatted_date = appt_time.strftime('%A, %d de %B de %Y')
-                        formatted_time = appt_time.strftime('%I:%M %p')
-                        await safe_send(update, context,
-                            "✅ *¡Cita confirmada por voz!*\n\n"
-                            f"*Fecha:* {formatted_date}\n"
-                            f"*Hora:* {formatted_time}\n\n"
-                            "Te enviaremos un recordatorio antes de tu cita.",
-                            parse_mode='Markdown')
-                        # Enviar correos (usuario y admin)
-                        try:
-                            body = (
-                                "Hola,\n\n"
-                                f"Tu cita ha sido confirmada para el {formatted_date} a las {formatted_time}.\n\n"
-                                "Ubicación: Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda\n"
-                                "Teléfono: 0412-3379711\n\n"
-                                "Si necesitas reprogramar, responde a este correo.\n\n"
-                                "Gracias."
-                            )
-                            html = build_confirmation_html(
-                                user_name=f"{user.first_name} {user.last_name or ''}".strip(),
-                                appointment_date=formatted_date,
-                                appointment_time=formatted_time,
-                                location='Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
-                                support_phone='0412-3379711',
-                                support_email='contacto@authenology.com.ve',
-                            )
-                            send_email_emailjs(user.email, "Confirmación de cita - Authenology", body, {
-                                'appointment_date': formatted_date,
-                                'appointment_time': formatted_time,
-                                'user_name': f"{user.first_name} {user.last_name or ''}".strip(),
-                                'location': 'Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
-                                'support_phone': '0412-3379711',
-                                'support_email': 'contacto@authenology.com.ve',
-                                'email_type': 'appointment_confirmation',
-                                'html': html,
-                            })
-                            notify_admin_appointment(
-                                ADMIN_NOTIFY_EMAILS,
-                                user_name=f"{user.first_name} {user.last_name or ''}".strip(),
-                                user_email=user.email or 'sin-email',
-                                formatted_date=formatted_date,
-                                formatted_time=formatted_time,
-                            )
-                        except Exception:
-                            pass
+                        await announce_booking(update, context, user, appt_time, title="✅ *¡Cita confirmada por voz!*")
                         context.user_data['current_state'] = 'HANDLE_MENU'
                         return HANDLE_MENU
                     else:
@@ -746,42 +955,35 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
                         context.user_data['await_email'] = True
                         await safe_send(update, context, "✉️ Antes de confirmar, por favor escribe tu correo electrónico para enviarte la confirmación.")
                         return COLLECT_EMAIL
-                finally:
-                    db.close()
                 # Si por algún motivo no se pudo auto-confirmar, mostrar confirmación UI
                 return await ask_confirm_for_time(update, context, slot['start'])
         await safe_send(update, context, "Entendido. Vamos a agendar tu cita.")
         return await show_time_slots_for_date(update, context, target_date)
 
-    pa = pricing_answer(lt)
+    pa = pricing_answer(msg)
     if pa:
         await safe_send(update, context, pa)
         await safe_send(update, context, "¿Fue útil esta información?", reply_markup=feedback_markup())
         context.user_data['current_state'] = 'HANDLE_MENU'
         return HANDLE_MENU
-    st = smalltalk_answer(lt)
+    st = smalltalk_answer(msg)
     if st:
         await safe_send(update, context, st, reply_markup=suggestions_markup())
         context.user_data['current_state'] = 'HANDLE_MENU'
         return HANDLE_MENU
-    sa = services_answer(lt)
+    sa = services_answer(msg)
     if sa:
         await safe_send(update, context, sa, reply_markup=support_markup())
         await safe_send(update, context, "¿Fue útil esta información?", reply_markup=feedback_markup())
         context.user_data['current_state'] = 'HANDLE_MENU'
         return HANDLE_MENU
-    if 'agendar' in lt or 'cita' in lt:
-        return await schedule_appointment(update, context)
-    if 'pregunta' in lt or 'faq' in lt:
-        return await show_faq_categories(update, context)
-    if 'contacto' in lt or 'ayuda' in lt:
-        return await show_contact_info(update, context)
-    if 'acerca' in lt or 'authenology' in lt:
-        return await show_about(update, context)
-    faq = best_faq_answer(lt)
+    menu = menu_intent(lt)
+    if menu:
+        return await _MENU_HANDLERS[menu](update, context)
+    faq = await asyncio.to_thread(best_faq_answer, msg)
     if faq:
         await safe_send(update, context, f"*{faq.question}*\n\n{faq.answer}")
-        await safe_send(update, context, "¿Necesitas más ayuda?", reply_markup=feedback_markup())
+        await safe_send(update, context, "¿Necesitas más ayuda?", reply_markup=feedback_markup(faq.id))
         context.user_data['current_state'] = 'HANDLE_MENU'
         return HANDLE_MENU
     await safe_send(update, context, support_blurb(), reply_markup=support_markup())
@@ -834,118 +1036,106 @@ async def handle_unknown_callback(update: Update, context: ContextTypes.DEFAULT_
     return await start(update, context)
 
 async def handle_feedback_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
-    """Persist feedback thumbs up/down."""
+    """Persist feedback thumbs up/down (1/-1), linked to the FAQ when the buttons carry its id."""
     query = update.callback_query
-    await query.answer()
-    val = 'up' if query.data == 'fb_up' else 'down'
-    db = QuestionsSession()
-    try:
-        text = None
-        if update.effective_message and update.effective_message.reply_to_message:
-            text = update.effective_message.reply_to_message.text
-        db.add(Feedback(
-            telegram_id=update.effective_user.id,
-            value=val,
-            question_text=text,
-            message_id=update.effective_message.message_id if update.effective_message else None,
-        ))
-        db.commit()
-    finally:
-        db.close()
+    vote, _, faq_id = query.data.partition(':')
+    log_analytics(
+        Feedback,
+        telegram_id=update.effective_user.id,
+        value=1 if vote == 'fb_up' else -1,
+        faq_id=int(faq_id) if faq_id else None,
+        message_id=update.effective_message.message_id if update.effective_message else None,
+    )
+    # Única respuesta al callback: un segundo answer() es rechazado por Telegram
     await query.answer(text="¡Gracias por tu feedback!", show_alert=False)
     return HANDLE_MENU
 async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle main menu selection"""
     # Support both text messages and callback queries
-    if update.message and update.message.text:
-        text = update.message.text.lower()
-    else:
-        text = ""
+    msg = normalize_msg(update.message.text if update.message else "")
+    text = msg.low
     
     # Log user question if it's free text (not a menu keyword)
-    keywords = ['agendar', 'cita', 'pregunta', 'faq', 'contacto', 'ayuda', 'acerca', 'authenology']
-    if not any(k in text for k in keywords):
-        # Try pricing intent first
-        pa = pricing_answer(text)
-        if pa:
-            await safe_send(update, context, pa)
-            await safe_send(update, context, "¿Fue útil esta información?", reply_markup=feedback_markup())
-            return HANDLE_MENU
-        # Small-talk intent
-        st = smalltalk_answer(text)
-        if st:
-            await safe_send(update, context, st, reply_markup=suggestions_markup())
-            return HANDLE_MENU
-        # Services intent
-        sa = services_answer(text)
-        if sa:
-            await safe_send(update, context, sa, reply_markup=support_markup())
-            await safe_send(update, context, "¿Fue útil esta información?", reply_markup=feedback_markup())
-            return HANDLE_MENU
-        qdb = QuestionsSession()
-        try:
-            uid, uname, fname, lname = get_user_info(update)
-            qdb.add(UserQuestion(
-                telegram_id=uid,
-                username=uname,
-                first_name=fname,
-                last_name=lname,
-                question_text=text,
-                source='text'
-            ))
-            qdb.commit()
-        finally:
-            qdb.close()
+    menu = menu_intent(text)
+    if menu is None:
+        intent_cue = has_intent_cue(msg)
+        if intent_cue:
+            # Try pricing intent first
+            pa = pricing_answer(msg)
+            if pa:
+                await safe_send(update, context, pa)
+                await safe_send(update, context, "¿Fue útil esta información?", reply_markup=feedback_markup())
+                return HANDLE_MENU
+            # Small-talk intent
+            st = smalltalk_answer(msg)
+            if st:
+                await safe_send(update, context, st, reply_markup=suggestions_markup())
+                return HANDLE_MENU
+            # Services intent
+            sa = services_answer(msg)
+            if sa:
+                await safe_send(update, context, sa, reply_markup=support_markup())
+                await safe_send(update, context, "¿Fue útil esta información?", reply_markup=feedback_markup())
+                return HANDLE_MENU
+        uid, uname, fname, lname = get_user_info(update)
+        log_analytics(
+            UserQuestion,
+            telegram_id=uid,
+            username=uname,
+            first_name=fname,
+            last_name=lname,
+            question_text=text,
+            source='text'
+        )
         # Renewal info intent
-        ra = renewal_info_answer(text)
+        ra = renewal_info_answer(msg) if intent_cue else None
         if ra:
             await safe_send(update, context, ra, reply_markup=support_markup())
             await safe_send(update, context, "¿Fue útil esta información?", reply_markup=feedback_markup())
             return HANDLE_MENU
         # Try to answer using FAQs
-        faq = best_faq_answer(text)
+        faq = await asyncio.to_thread(best_faq_answer, msg)
         if faq:
             await safe_send(update, context, f"*{faq.question}*\n\n{faq.answer}")
-            await safe_send(update, context, "¿Necesitas más ayuda?", reply_markup=feedback_markup())
+            await safe_send(update, context, "¿Necesitas más ayuda?", reply_markup=feedback_markup(faq.id))
             return HANDLE_MENU
         else:
             await safe_send(update, context, support_blurb(), reply_markup=support_markup())
             await safe_send(update, context, "También puedes elegir una opción:", reply_markup=suggestions_markup())
             return HANDLE_MENU
     
-    if 'agendar' in text or 'cita' in text:
-        return await schedule_appointment(update, context)
-    elif 'pregunta' in text or 'faq' in text:
-        return await show_faq_categories(update, context)
-    elif 'contacto' in text or 'ayuda' in text:
-        return await show_contact_info(update, context)
-    elif 'acerca' in text or 'authenology' in text:
-        return await show_about(update, context)
-    else:
-        await safe_send(update, context, "No entendí tu solicitud. Por favor, selecciona una opción del menú.")
-        return HANDLE_MENU
+    handler = _MENU_HANDLERS.get(menu)
+    if handler:
+        return await handler(update, context)
+    await safe_send(update, context, "No entendí tu solicitud. Por favor, selecciona una opción del menú.")
+    return HANDLE_MENU
+
+@lru_cache(maxsize=1)
+def dates_markup(today) -> InlineKeyboardMarkup:
+    """Keyboard with the next 14 days; identical for every user until the date rolls over."""
+    available_dates = [today + timedelta(days=i) for i in range(1, 15)]
+    buttons = [
+        InlineKeyboardButton(day.strftime('%d/%m'), callback_data=f"date_{day.isoformat()}")
+        for day in available_dates
+    ]
+    # Filas de 3 botones
+    return InlineKeyboardMarkup([buttons[i:i + 3] for i in range(0, len(buttons), 3)])
+
+@lru_cache(maxsize=128)
+def time_slots_markup(slot_starts: tuple) -> InlineKeyboardMarkup:
+    """Keyboard with one button per free slot start plus the back button."""
+    buttons = [
+        InlineKeyboardButton(start.strftime('%H:%M'), callback_data=f"time_{start.isoformat()}")
+        for start in slot_starts
+    ]
+    keyboard = [buttons[i:i + 3] for i in range(0, len(buttons), 3)]
+    keyboard.append([InlineKeyboardButton("🔙 Seleccionar otra fecha", callback_data="back_to_dates")])
+    return InlineKeyboardMarkup(keyboard)
 
 async def schedule_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Start the appointment scheduling process"""
-    # Get available dates (next 14 days)
-    today = get_tznow().date()
-    available_dates = [today + timedelta(days=i) for i in range(1, 15)]
-    
-    # Create keyboard with available dates
-    keyboard = []
-    row = []
-    for i, date in enumerate(available_dates, 1):
-        row.append(InlineKeyboardButton(
-            date.strftime('%d/%m'),
-            callback_data=f"date_{date.isoformat()}"
-        ))
-        if i % 3 == 0:
-            keyboard.append(row)
-            row = []
-    if row:  # Add remaining buttons
-        keyboard.append(row)
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    # Keyboard with the next 14 days, built once per calendar day
+    reply_markup = dates_markup(get_tznow().date())
     
     text = (
         "📅 *Selecciona una fecha para tu cita:*\n"
@@ -967,7 +1157,7 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
     await query.answer()
     
     # Extract selected date from callback data
-    selected_date = datetime.strptime(query.data.split('_')[1], '%Y-%m-%d').date()
+    selected_date = date.fromisoformat(query.data.split('_', 1)[1])
     context.user_data['appointment_date'] = selected_date
     
     # Get available time slots from DB
@@ -983,52 +1173,39 @@ async def select_time(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int
         )
         return SELECT_DATE
     
-    # Create time slot buttons
-    keyboard = []
-    row = []
-    for i, slot in enumerate(time_slots, 1):
-        time_str = slot['start'].strftime('%H:%M')
-        row.append(InlineKeyboardButton(
-            time_str,
-            callback_data=f"time_{slot['start'].isoformat()}"
-        ))
-        if i % 3 == 0:
-            keyboard.append(row)
-            row = []
-    if row:  # Add remaining buttons
-        keyboard.append(row)
-    
-    # Add back button
-    keyboard.append([InlineKeyboardButton("🔙 Seleccionar otra fecha", callback_data="back_to_dates")])
-    
     await query.edit_message_text(
         f"⏰ *Selecciona un horario para el {selected_date.strftime('%d/%m/%Y')}:*",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=time_slots_markup(tuple(slot['start'] for slot in time_slots)),
         parse_mode='Markdown'
     )
     
     context.user_data['current_state'] = 'SELECT_TIME'
     return SELECT_TIME
 
-def parse_spanish_time(text: str):
+_TIME_HHMM_RE = re.compile(r"\b(\d{1,2}):(\d{2})\b")
+_TIME_ALAS_RE = re.compile(r"a\s+l[ao]s?\s+(\d{1,2})\b")
+_TIME_AMPM_RE = re.compile(r"\b(\d{1,2})\s*(am|pm)\b")
+_PM_HINT_RE = _keywords_re(['de la tarde', 'de la noche', 'pm'])
+_AM_HINT_RE = _keywords_re(['de la mañana', 'de la manana', 'am'])
+
+def parse_spanish_time(msg: NormalizedMsg):
     """Parse simple Spanish time mentions: '2 pm', '2 de la tarde', '14:30', 'a las 9', returns (hour, minute) or None."""
-    import re
-    t = text.lower()
+    t = msg.low
     # Explicit HH:MM or H:MM
-    m = re.search(r"\b(\d{1,2}):(\d{2})\b", t)
+    m = _TIME_HHMM_RE.search(t)
     if m:
         h = int(m.group(1))
         mi = int(m.group(2))
         if 0 <= h <= 23 and 0 <= mi <= 59:
             return h, mi
     # Patterns like 'a las 2', 'a la 1'
-    m = re.search(r"a\s+l[ao]s?\s+(\d{1,2})\b", t)
-    ampm = None
-    if 'de la tarde' in t or 'de la noche' in t or 'pm' in t:
-        ampm = 'pm'
-    if 'de la mañana' in t or 'de la manana' in t or 'am' in t:
-        ampm = ampm or 'am'
+    m = _TIME_ALAS_RE.search(t)
     if m:
+        ampm = None
+        if _PM_HINT_RE.search(t):
+            ampm = 'pm'
+        elif _AM_HINT_RE.search(t):
+            ampm = 'am'
         h = int(m.group(1))
         mi = 0
         if ampm == 'pm' and h < 12:
@@ -1038,7 +1215,7 @@ def parse_spanish_time(text: str):
         if 0 <= h <= 23:
             return h, mi
     # Single hour with 'pm/am'
-    m = re.search(r"\b(\d{1,2})\s*(am|pm)\b", t)
+    m = _TIME_AMPM_RE.search(t)
     if m:
         h = int(m.group(1))
         mi = 0
@@ -1056,29 +1233,23 @@ def pick_best_slot_for_datetime(target_date, hour: int, minute: int):
     if not slots:
         return None
     target_dt = ensure_tz(datetime.combine(target_date, dtime(hour, minute)))
-    # Prefer exact hour/minute match if exists
-    exact = [s for s in slots if s['start'].hour == hour and s['start'].minute == minute]
-    if exact:
-        return exact[0]
-    # Otherwise next available after target
-    after = [s for s in slots if s['start'] >= target_dt]
-    if after:
-        after.sort(key=lambda s: s['start'])
-        return after[0]
-    # Or the last of the day as fallback
-    slots.sort(key=lambda s: s['start'])
-    return slots[-1] if slots else None
+    # One pass: exact hour/minute match, else next available after target, else the last of the day
+    exact = best_after = last = None
+    for s in slots:
+        st = s['start']
+        if exact is None and st.hour == hour and st.minute == minute:
+            exact = s
+        if st >= target_dt and (best_after is None or st < best_after['start']):
+            best_after = s
+        if last is None or st >= last['start']:
+            last = s
+    return exact or best_after or last
 
 async def ask_confirm_for_time(update: Update, context: ContextTypes.DEFAULT_TYPE, selected_time: datetime) -> int:
     """Send confirmation UI for a concrete selected_time without needing a callback prior."""
     context.user_data['appointment_date'] = selected_time.date()
     context.user_data['appointment_time'] = selected_time
-    formatted_date = selected_time.strftime('%A, %d de %B de %Y')
-    formatted_time = selected_time.strftime('%I:%M %p')
-    keyboard = [[
-        InlineKeyboardButton("✅ Confirmar", callback_data="confirm_appt"),
-        InlineKeyboardButton("❌ Cancelar", callback_data="cancel_appt")
-    ]]
+    formatted_date, formatted_time = format_appointment(selected_time)
     await safe_send(
         update,
         context,
@@ -1086,36 +1257,45 @@ async def ask_confirm_for_time(update: Update, context: ContextTypes.DEFAULT_TYP
         f"*Fecha:* {formatted_date}\n"
         f"*Hora:* {formatted_time}\n\n"
         "¿Deseas confirmar esta cita?",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_CONFIRM_APPT_MARKUP,
         parse_mode='Markdown'
     )
     context.user_data['current_state'] = 'CONFIRM_APPOINTMENT'
     return CONFIRM_APPOINTMENT
 
-def parse_spanish_date(text: str):
+# Relative-day and weekday mentions in one pass; the lookahead reports overlapping hits
+# ('pasado mañana' also contains 'mañana') and the caller applies the old precedence
+_DATE_WORDS_RE = re.compile(
+    r'(?=(?P<pasado>pasado ma[ñn]ana)'
+    r'|(?P<manana>ma[ñn]ana)'
+    r'|(?P<hoy>hoy)'
+    r'|(?P<weekday>lunes|martes|mi[ée]rcoles|jueves|viernes|s[áa]bado|domingo))'
+)
+_WEEKDAY_IDX = {
+    'lunes': 0, 'martes': 1, 'miércoles': 2, 'miercoles': 2, 'jueves': 3, 'viernes': 4, 'sábado': 5, 'sabado': 5, 'domingo': 6
+}
+
+def parse_spanish_date(msg: NormalizedMsg):
     """Parse simple Spanish date mentions: hoy, mañana, pasado mañana, weekdays.
     Returns a datetime.date or None.
     """
-    if not text:
+    if not msg.low:
+        return None
+    found = {}
+    for m in _DATE_WORDS_RE.finditer(msg.low):
+        found.setdefault(m.lastgroup, []).append(m.group(m.lastgroup))
+    if not found:
         return None
-    t = text.lower()
     now = get_tznow().date()
-    if 'pasado mañana' in t or 'pasado manana' in t:
+    if 'pasado' in found:
         return now + timedelta(days=2)
-    if 'mañana' in t or 'manana' in t:
+    if 'manana' in found:
         return now + timedelta(days=1)
-    if 'hoy' in t:
+    if 'hoy' in found:
         return now
-    weekdays = {
-        'lunes': 0, 'martes': 1, 'miércoles': 2, 'miercoles': 2, 'jueves': 3, 'viernes': 4, 'sábado': 5, 'sabado': 5, 'domingo': 6
-    }
-    for name, idx in weekdays.items():
-        if name in t:
-            today_idx = now.weekday()
-            delta = (idx - today_idx) % 7
-            delta = 7 if delta == 0 else delta
-            return now + timedelta(days=delta)
-    return None
+    # Earliest weekday of the week wins (as the old dict scan did); same weekday means next week
+    idx = min(_WEEKDAY_IDX[name] for name in found['weekday'])
+    return now + timedelta(days=(idx - now.weekday() - 1) % 7 + 1)
 
 async def show_time_slots_for_date(update: Update, context: ContextTypes.DEFAULT_TYPE, selected_date) -> int:
     """Show available time slots for a given date without requiring a callback query."""
@@ -1125,20 +1305,9 @@ async def show_time_slots_for_date(update: Update, context: ContextTypes.DEFAULT
         await safe_send(update, context,
             "Lo siento, no hay horarios disponibles para la fecha seleccionada. Por favor, indícame otro día (por ejemplo: 'viernes' o 'mañana').")
         return SELECT_DATE
-    keyboard = []
-    row = []
-    for i, slot in enumerate(time_slots, 1):
-        time_str = slot['start'].strftime('%H:%M')
-        row.append(InlineKeyboardButton(time_str, callback_data=f"time_{slot['start'].isoformat()}"))
-        if i % 3 == 0:
-            keyboard.append(row)
-            row = []
-    if row:
-        keyboard.append(row)
-    keyboard.append([InlineKeyboardButton("🔙 Seleccionar otra fecha", callback_data="back_to_dates")])
     await safe_send(update, context,
         f"⏰ *Selecciona un horario para el {selected_date.strftime('%d/%m/%Y')}:*",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=time_slots_markup(tuple(slot['start'] for slot in time_slots)),
         parse_mode='Markdown')
     context.user_data['current_state'] = 'SELECT_TIME'
     return SELECT_TIME
@@ -1156,23 +1325,14 @@ async def confirm_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE
     context.user_data['appointment_time'] = selected_time
     
     # Format the date and time
-    formatted_date = selected_time.strftime('%A, %d de %B de %Y')
-    formatted_time = selected_time.strftime('%I:%M %p')
-    
-    # Create confirmation keyboard
-    keyboard = [
-        [
-            InlineKeyboardButton("✅ Confirmar", callback_data="confirm_appt"),
-            InlineKeyboardButton("❌ Cancelar", callback_data="cancel_appt")
-        ]
-    ]
+    formatted_date, formatted_time = format_appointment(selected_time)
     
     await query.edit_message_text(
         f"📝 *Confirmación de cita*\n\n"
         f"*Fecha:* {formatted_date}\n"
         f"*Hora:* {formatted_time}\n\n"
         "¿Deseas confirmar esta cita?",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=_CONFIRM_APPT_MARKUP,
         parse_mode='Markdown'
     )
     
@@ -1194,140 +1354,112 @@ async def save_appointment(update: Update, context: ContextTypes.DEFAULT_TYPE) -
     
     # Get user data
     user_id = update.effective_user.id
-    db = next(get_appt_db())
-    user = db.query(User).filter(User.telegram_id == user_id).first()
+    with appt_session() as db:
+        user = get_booking_user(db, user_id)
     
-    if not user:
-        await query.edit_message_text(
-            "❌ *Error*\n\n"
-            "No se pudo encontrar tu información de usuario. Por favor, inicia el bot nuevamente con /start.",
-            parse_mode='Markdown'
-        )
-        return HANDLE_MENU
+        if not user:
+            await query.edit_message_text(
+                "❌ *Error*\n\n"
+                "No se pudo encontrar tu información de usuario. Por favor, inicia el bot nuevamente con /start.",
+                parse_mode='Markdown'
+            )
+            return HANDLE_MENU
     
-    # Get appointment details
-    appointment_date = context.user_data.get('appointment_date')
-    appointment_time = context.user_data.get('appointment_time')
+        # Get appointment details
+        appointment_date = context.user_data.get('appointment_date')
+        appointment_time = context.user_data.get('appointment_time')
     
-    if not all([appointment_date, appointment_time]):
-        await query.edit_message_text(
-            "❌ *Error*\n\n"
-            "No se pudo obtener la información de la cita. Por favor, intenta nuevamente.",
-            parse_mode='Markdown'
-        )
-        return HANDLE_MENU
+        if not all([appointment_date, appointment_time]):
+            await query.edit_message_text(
+                "❌ *Error*\n\n"
+                "No se pudo obtener la información de la cita. Por favor, intenta nuevamente.",
+                parse_mode='Markdown'
+            )
+            return HANDLE_MENU
 
-    # If user doesn't have email, ask for it before saving the appointment
-    if not user.email:
-        context.user_data['await_email'] = True
-        await query.edit_message_text(
-            "✉️ *Antes de confirmar*, por favor escribe tu correo electrónico para enviarte la confirmación de la cita.",
-            parse_mode='Markdown'
-        )
-        db.close()
-        return COLLECT_EMAIL
+        # If user doesn't have email, ask for it before saving the appointment
+        if not user.email:
+            context.user_data['await_email'] = True
+            await query.edit_message_text(
+                "✉️ *Antes de confirmar*, por favor escribe tu correo electrónico para enviarte la confirmación de la cita.",
+                parse_mode='Markdown'
+            )
+            return COLLECT_EMAIL
 
-    try:
-        # Ensure the slot is still available
-        if not is_slot_available(appointment_time, appointment_time + timedelta(minutes=30)):
-            raise Exception("El horario seleccionado ya no está disponible.")
-
-        # Save appointment to database
-        appointment = Appointment(
-            user_id=user.id,
-            appointment_date=appointment_time,
-            duration_minutes=30,
-            status=AppointmentStatus.CONFIRMED
-        )
-        db.add(appointment)
-        db.commit()
+        try:
+            # Ensure the slot is still available
+            appointment = book_slot(db, user, appointment_time)
+            if appointment is None:
+                raise Exception("El horario seleccionado ya no está disponible.")
+
+            await announce_booking(update, context, user, appointment_time,
+                                   footer="Te enviaremos un recordatorio antes de tu cita.\n\n"
+                                          f"📍 *Ubicación:* {BUSINESS_INFO['location']}\n"
+                                          f"📞 *Teléfono:* {BUSINESS_INFO['support_phone']}\n\n"
+                                          "¿Necesitas ayuda con algo más?",
+                                   edit=query.edit_message_text)
+
+        except Exception as e:
+            db.rollback()
+            logger.error(f"Error saving appointment: {e}")
+            await query.edit_message_text(
+                "❌ *Error*\n\n"
+                "No se pudo agendar la cita. Por favor, inténtalo de nuevo más tarde o contáctanos para asistencia.",
+                parse_mode='Markdown'
+            )
 
-        # Format confirmation message
-        formatted_date = appointment_time.strftime('%A, %d de %B de %Y')
-        formatted_time = appointment_time.strftime('%I:%M %p')
+    return HANDLE_MENU
 
-        await query.edit_message_text(
-            "✅ *¡Cita confirmada!*\n\n"
-            f"*Fecha:* {formatted_date}\n"
-            f"*Hora:* {formatted_time}\n\n"
-            "Te enviaremos un recordatorio antes de tu cita.\n\n"
-            "📍 *Ubicación:* Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda\n"
-            "📞 *Teléfono:* 0412-3379711\n\n"
-            "¿Necesitas ayuda con algo más?",
-            parse_mode='Markdown'
-        )
+# Static menu keyboards, built once at import
+_FAQ_CATEGORIES = [
+    ("general", "📋 General"),
+    ("legal", "⚖️ Legal"),
+    ("tecnico", "💻 Técnico"),
+    ("facturacion", "💰 Facturación"),
+    ("uso", "🧭 Uso de la plataforma"),
+    ("pagos", "💵 Pagos"),
+]
+
+_FAQ_CATEGORIES_MARKUP = InlineKeyboardMarkup(
+    [[InlineKeyboardButton(text, callback_data=f"faqcat_{cat}")] for cat, text in _FAQ_CATEGORIES]
+    + [[InlineKeyboardButton("🔙 Menú principal", callback_data="back_to_menu")]]
+)
 
-        # Send email confirmation via EmailJS
-        try:
-            body = (
-                "Hola,\n\n"
-                f"Tu cita ha sido confirmada para el {formatted_date} a las {formatted_time}.\n\n"
-                "Ubicación: Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda\n"
-                "Teléfono: 0412-3379711\n\n"
-                "Si necesitas reprogramar, responde a este correo.\n\n"
-                "Gracias."
-            )
-            html = build_confirmation_html(
-                user_name=f"{user.first_name} {user.last_name or ''}".strip(),
-                appointment_date=formatted_date,
-                appointment_time=formatted_time,
-                location='Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
-                support_phone='0412-3379711',
-                support_email='contacto@authenology.com.ve',
-            )
-            send_email_emailjs(user.email, "Confirmación de cita - Authenology", body, {
-                'appointment_date': formatted_date,
-                'appointment_time': formatted_time,
-                'user_name': f"{user.first_name} {user.last_name or ''}".strip(),
-                'location': 'Avenida Bolívar, Edificio Don David, Oficina 001, PB, Chacao, estado Miranda',
-                'support_phone': '0412-3379711',
-                'support_email': 'contacto@authenology.com.ve',
-                'email_type': 'appointment_confirmation',
-                'html': html,
-            })
-            # Notificar a administradores
-            notify_admin_appointment(
-                ADMIN_NOTIFY_EMAILS,
-                user_name=f"{user.first_name} {user.last_name or ''}".strip(),
-                user_email=user.email or 'sin-email',
-                formatted_date=formatted_date,
-                formatted_time=formatted_time,
-            )
-        except Exception:
-            pass
+_BACK_TO_CATEGORIES_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Volver a categorías", callback_data="back_to_categories")]
+])
 
-    except Exception as e:
-        logger.error(f"Error saving appointment: {e}")
-        await query.edit_message_text(
-            "❌ *Error*\n\n"
-            "No se pudo agendar la cita. Por favor, inténtalo de nuevo más tarde o contáctanos para asistencia.",
-            parse_mode='Markdown'
-        )
-    finally:
-        db.close()
+_BACK_TO_FAQS_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔙 Volver a preguntas", callback_data="back_to_faqs")]
+])
 
-    return HANDLE_MENU
+_FAQ_ANSWER_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("🔙 Volver a preguntas", callback_data="back_to_faqs"),
+        InlineKeyboardButton("📞 Contactar soporte", callback_data="contact_support")
+    ]
+])
+
+_CONTACT_MARKUP = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📅 Agendar cita", callback_data="schedule_appt")],
+    [
+        InlineKeyboardButton("🖥️ Abrir App Web", url="https://app.authenology.com.ve"),
+        InlineKeyboardButton("🌐 Sitio Web", url="https://www.authenology.com.ve")
+    ],
+    [InlineKeyboardButton("🔙 Menú principal", callback_data="back_to_menu")]
+])
+
+_ABOUT_MARKUP = InlineKeyboardMarkup([
+    [
+        InlineKeyboardButton("📅 Agendar cita", callback_data="schedule_appt"),
+        InlineKeyboardButton("📞 Contacto", callback_data="contact_info")
+    ],
+    [InlineKeyboardButton("🔙 Menú principal", callback_data="back_to_menu")]
+])
 
 async def show_faq_categories(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Show FAQ categories"""
-    categories = [
-        ("general", "📋 General"),
-        ("legal", "⚖️ Legal"),
-        ("tecnico", "💻 Técnico"),
-        ("facturacion", "💰 Facturación"),
-        ("uso", "🧭 Uso de la plataforma"),
-        ("pagos", "💵 Pagos"),
-    ]
-    
-    keyboard = [
-        [InlineKeyboardButton(text, callback_data=f"faqcat_{cat}")]
-        for cat, text in categories
-    ]
-    
-    # Add back button
-    keyboard.append([InlineKeyboardButton("🔙 Menú principal", callback_data="back_to_menu")])
-    
-    reply_markup = InlineKeyboardMarkup(keyboard)
+    reply_markup = _FAQ_CATEGORIES_MARKUP
     
     if update.callback_query:
         await update.callback_query.edit_message_text(
@@ -1359,37 +1491,19 @@ async def show_faqs(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     
     # Get FAQs from questions database
     category = query.data.split('_', 1)[1]
-    qdb = QuestionsSession()
-    try:
-        faqs = qdb.query(FAQ).filter(
-            FAQ.category == category,
-            FAQ.is_active == True
-        ).all()
-    finally:
-        qdb.close()
+    faqs = get_faqs_by_category(category)
     
     if not faqs:
         await query.edit_message_text(
             "No hay preguntas frecuentes disponibles en esta categoría.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Volver a categorías", callback_data="back_to_categories")]
-            ])
+            reply_markup=_BACK_TO_CATEGORIES_MARKUP
         )
         return HANDLE_FAQ
     
-    # Create FAQ buttons
-    keyboard = [
-        [InlineKeyboardButton(faq.question, callback_data=f"faq_{faq.id}")]
-        for faq in faqs
-    ]
-    
-    # Add back button
-    keyboard.append([InlineKeyboardButton("🔙 Volver a categorías", callback_data="back_to_categories")])
-    
     await query.edit_message_text(
         f"❓ *Preguntas frecuentes - {category.capitalize()}*\n\n"
         "Selecciona una pregunta para ver la respuesta:",
-        reply_markup=InlineKeyboardMarkup(keyboard),
+        reply_markup=faqs_markup(category),
         parse_mode='Markdown'
     )
     
@@ -1406,18 +1520,12 @@ async def show_faq_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     # Get FAQ from database
     faq_id = int(query.data.split('_', 1)[1])
-    qdb = QuestionsSession()
-    try:
-        faq = qdb.query(FAQ).filter(FAQ.id == faq_id).first()
-    finally:
-        qdb.close()
+    faq = get_faq_by_id(faq_id)
     
     if not faq:
         await query.edit_message_text(
             "No se encontró la pregunta seleccionada.",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Volver a preguntas", callback_data=f"back_to_faqs")]
-            ])
+            reply_markup=_BACK_TO_FAQS_MARKUP
         )
         return HANDLE_FAQ
     
@@ -1427,12 +1535,7 @@ async def show_faq_answer(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     await query.edit_message_text(
         f"*{faq.question}*\n\n{faq.answer}\n\n"
         "¿Necesitas más ayuda?",
-        reply_markup=InlineKeyboardMarkup([
-            [
-                InlineKeyboardButton("🔙 Volver a preguntas", callback_data="back_to_faqs"),
-                InlineKeyboardButton("📞 Contactar soporte", callback_data="contact_support")
-            ]
-        ]),
+        reply_markup=_FAQ_ANSWER_MARKUP,
         parse_mode='Markdown'
     )
     
@@ -1458,26 +1561,17 @@ async def show_contact_info(update: Update, context: ContextTypes.DEFAULT_TYPE)
         "Lunes a Viernes: 8:00 AM - 5:00 PM"
     )
     
-    keyboard = [
-        [InlineKeyboardButton("📅 Agendar cita", callback_data="schedule_appt")],
-        [
-            InlineKeyboardButton("🖥️ Abrir App Web", url="https://app.authenology.com.ve"),
-            InlineKeyboardButton("🌐 Sitio Web", url="https://www.authenology.com.ve")
-        ],
-        [InlineKeyboardButton("🔙 Menú principal", callback_data="back_to_menu")]
-    ]
-    
     if update.callback_query:
         await update.callback_query.edit_message_text(
             contact_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_CONTACT_MARKUP,
             parse_mode='Markdown',
             disable_web_page_preview=True
         )
     else:
         await update.message.reply_text(
             contact_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_CONTACT_MARKUP,
             parse_mode='Markdown',
             disable_web_page_preview=True
         )
@@ -1499,25 +1593,17 @@ async def show_about(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         "*¿Listo para empezar?* Visita nuestra app web y registrate: app.authenology.com.ve"
     )
     
-    keyboard = [
-        [
-            InlineKeyboardButton("📅 Agendar cita", callback_data="schedule_appt"),
-            InlineKeyboardButton("📞 Contacto", callback_data="contact_info")
-        ],
-        [InlineKeyboardButton("🔙 Menú principal", callback_data="back_to_menu")]
-    ]
-    
     if update.callback_query:
         await update.callback_query.edit_message_text(
             about_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_ABOUT_MARKUP,
             parse_mode='Markdown',
             disable_web_page_preview=True
         )
     else:
         await update.message.reply_text(
             about_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            reply_markup=_ABOUT_MARKUP,
             parse_mode='Markdown',
             disable_web_page_preview=True
         )
@@ -1538,45 +1624,48 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
         pass
     return ConversationHandler.END
 
+# menu_intent() tag -> handler, shared by handle_menu and the voice intent flow
+_MENU_HANDLERS = {
+    'schedule': schedule_appointment,
+    'faq': show_faq_categories,
+    'contact': show_contact_info,
+    'about': show_about,
+}
+
+# Router and reply markup per voice intent; each router always answers once its cue is present
+_VOICE_ROUTERS = {
+    'price': (pricing_answer, None),
+    'services': (services_answer, _SUPPORT_MARKUP),
+    'renewal': (renewal_info_answer, _SUPPORT_MARKUP),
+}
+
 async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Handle incoming voice messages"""
     text = await voice_handler.handle_voice_message(update, context)
     if text:
+        msg = normalize_msg(text)
         # Log question
-        qdb = QuestionsSession()
-        try:
-            uid, uname, fname, lname = get_user_info(update)
-            qdb.add(UserQuestion(
-                telegram_id=uid,
-                username=uname,
-                first_name=fname,
-                last_name=lname,
-                question_text=text,
-                source='voice'
-            ))
-            qdb.commit()
-        finally:
-            qdb.close()
-        # Pricing intent
-        pa = pricing_answer(text)
-        if pa:
-            await safe_send(update, context, pa)
-            return HANDLE_MENU
-        # Services intent
-        sa = services_answer(text)
-        if sa:
-            await safe_send(update, context, sa, reply_markup=support_markup())
-            return HANDLE_MENU
-        # Renewal info intent
-        ra = renewal_info_answer(text)
-        if ra:
-            await safe_send(update, context, ra, reply_markup=support_markup())
+        uid, uname, fname, lname = get_user_info(update)
+        log_analytics(
+            UserQuestion,
+            telegram_id=uid,
+            username=uname,
+            first_name=fname,
+            last_name=lname,
+            question_text=text,
+            source='voice'
+        )
+        # Pricing / services / renewal intent: one scan picks the router that answers
+        intent = voice_intent(msg)
+        if intent:
+            router, markup = _VOICE_ROUTERS[intent]
+            await safe_send(update, context, router(msg), reply_markup=markup)
             return HANDLE_MENU
         # FAQ match
-        faq = best_faq_answer(text)
+        faq = await asyncio.to_thread(best_faq_answer, msg)
         if faq:
             await safe_send(update, context, f"*{faq.question}*\n\n{faq.answer}")
-            await safe_send(update, context, "¿Necesitas más ayuda?", reply_markup=feedback_markup())
+            await safe_send(update, context, "¿Necesitas más ayuda?", reply_markup=feedback_markup(faq.id))
         else:
             await safe_send(update, context, support_blurb(), reply_markup=support_markup())
             await safe_send(update, context, "También puedes elegir una opción:", reply_markup=suggestions_markup())
@@ -1584,73 +1673,132 @@ async def handle_voice_message(update: Update, context: ContextTypes.DEFAULT_TYP
 
 # (no standalone handle_text; text is handled in handle_menu)
 
-def daterange_slots(date_obj) -> List[Dict[str, datetime]]:
-    tz = pytz.timezone(TIMEZONE)
-    start_dt = tz.localize(datetime.combine(date_obj, dtime(hour=BUSINESS_HOURS_START)))
-    end_dt = tz.localize(datetime.combine(date_obj, dtime(hour=BUSINESS_HOURS_END)))
-    slots = []
-    cur = start_dt
+# Estados que ocupan un horario (todo excepto CANCELLED), como lista para poder usar el índice (status, appointment_date)
+_ACTIVE_APPT_STATUSES = [st for st in AppointmentStatus if st != AppointmentStatus.CANCELLED]
+
+@lru_cache(maxsize=64)
+def daterange_slots(date_obj) -> tuple:
+    """30-minute business-hour slots of a day; cached, so callers must not mutate the dicts."""
+    start_dt = datetime.combine(date_obj, dtime(hour=BUSINESS_HOURS_START), tzinfo=_TZ)
     step = timedelta(minutes=30)
-    while cur + step <= end_dt:
-        slots.append({'start': cur, 'end': cur + step})
-        cur += step
-    return slots
+    # Slot boundaries as offsets from the opening time; each slot's end is the next one's start
+    bounds = [start_dt + i * step for i in range(max(BUSINESS_HOURS_END - BUSINESS_HOURS_START, 0) * 2 + 1)]
+    return tuple({'start': a, 'end': b} for a, b in zip(bounds, bounds[1:]))
+
+def get_booking_user(db, telegram_id: int):
+    """Row with just the columns booking needs (id, email, names); skips ORM hydration for read-only paths."""
+    return db.execute(
+        select(User.id, User.email, User.first_name, User.last_name).where(User.telegram_id == telegram_id)
+    ).first()
 
-def is_slot_available(start_dt: datetime, end_dt: datetime) -> bool:
-    db = ApptSession()
+def book_slot(db, user, appt_time: datetime) -> Optional[Appointment]:
+    """Insert a confirmed 30-min appointment if the slot is free; None if it is (or just got) taken.
+
+    The partial unique index on active appointment dates makes the insert itself the arbiter,
+    so two concurrent bookings that both pass is_slot_available cannot both commit.
+    """
+    if not is_slot_available(appt_time, appt_time + timedelta(minutes=30), db):
+        return None
+    appointment = Appointment(
+        user_id=user.id,
+        appointment_date=appt_time,
+        duration_minutes=30,
+        status=AppointmentStatus.CONFIRMED
+    )
+    db.add(appointment)
     try:
-        tz = pytz.timezone(TIMEZONE)
-        start_dt = ensure_tz(start_dt)
-        end_dt = ensure_tz(end_dt)
-        day = start_dt.astimezone(tz).date()
-        day_start = tz.localize(datetime.combine(day, dtime.min))
-        day_end = tz.localize(datetime.combine(day, dtime.max))
-        appts = db.query(Appointment).filter(
-            Appointment.appointment_date >= day_start,
-            Appointment.appointment_date <= day_end,
-            Appointment.status != AppointmentStatus.CANCELLED
-        ).all()
-        for a in appts:
-            a_start = ensure_tz(a.appointment_date)
-            a_end = a_start + timedelta(minutes=a.duration_minutes)
-            if start_dt < a_end and end_dt > a_start:
-                return False
-        return True
-    finally:
-        db.close()
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        appointment = None
+    invalidate_slots_cache(appt_time.date())
+    return appointment
+
+def is_slot_available(start_dt: datetime, end_dt: datetime, db=None) -> bool:
+    """Check overlap against non-cancelled appointments. Pass `db` to reuse the caller's session."""
+    if db is None:
+        with appt_session() as db:
+            return is_slot_available(start_dt, end_dt, db)
+    start_dt = ensure_tz(start_dt)
+    end_dt = ensure_tz(end_dt)
+    # Mismo criterio que _query_available_slots: hay choque si una cita del día empieza antes de
+    # end_dt y termina (según su propia duración) después de start_dt; la base resuelve el EXISTS
+    day_start = datetime.combine(start_dt.date(), dtime.min, tzinfo=_TZ)
+    overlapping = exists().where(
+        Appointment.status.in_(_ACTIVE_APPT_STATUSES),
+        Appointment.appointment_date >= day_start,
+        Appointment.appointment_date < end_dt,
+        _appointment_end_sql(db.get_bind().dialect.name) > start_dt,
+    )
+    if db.execute(select(overlapping)).scalar():
+        # El cache de horarios pudo ofrecer este slot ya ocupado: descartarlo para ese día
+        invalidate_slots_cache(start_dt.date())
+        return False
+    return True
+
+def _appointment_end_sql(dialect: str):
+    """SQL for appointment_date + duration_minutes (NULL counts as 30, like _active_appointments)."""
+    minutes = func.coalesce(Appointment.duration_minutes, 30)
+    if dialect == 'sqlite':
+        # Same text layout SQLAlchemy stores, so the comparison with bound datetimes stays ordered
+        end = func.strftime('%Y-%m-%d %H:%M:%f', Appointment.appointment_date, func.printf('+%d minutes', minutes))
+    else:
+        end = Appointment.appointment_date + func.make_interval(0, 0, 0, 0, 0, minutes)
+    return type_coerce(end, DateTime)
+
+def _active_appointments(db, since: datetime, until: datetime) -> List[tuple]:
+    """(start, end) of the non-cancelled appointments starting in [since, until), in start order."""
+    rows = db.execute(
+        select(Appointment.appointment_date, Appointment.duration_minutes).where(
+            Appointment.appointment_date >= since,
+            Appointment.appointment_date < until,
+            Appointment.status.in_(_ACTIVE_APPT_STATUSES),
+        ).order_by(Appointment.appointment_date)
+    ).all()
+    appts = []
+    for start, minutes in rows:
+        start = ensure_tz(start)
+        appts.append((start, start + timedelta(minutes=minutes or 30)))
+    return appts
+
+def invalidate_slots_cache(date_obj) -> None:
+    _SLOTS_CACHE.pop(date_obj, None)
 
 def get_available_slots_from_db(date_obj) -> List[Dict[str, datetime]]:
-    tz = pytz.timezone(TIMEZONE)
+    """Free 30-min slots for the day, memoized for SLOTS_CACHE_TTL seconds per date."""
+    now = time.monotonic()
+    cached = _SLOTS_CACHE.get(date_obj)
+    if cached and now - cached[0] < SLOTS_CACHE_TTL:
+        return cached[1]
+    available = _query_available_slots(date_obj)
+    # Descartar días vencidos para que el dict no crezca sin límite
+    for key in [k for k, (ts, _) in _SLOTS_CACHE.items() if now - ts >= SLOTS_CACHE_TTL]:
+        del _SLOTS_CACHE[key]
+    _SLOTS_CACHE[date_obj] = (now, available)
+    return available
+
+def _query_available_slots(date_obj) -> List[Dict[str, datetime]]:
     all_slots = daterange_slots(date_obj)
+    day_start = datetime.combine(date_obj, dtime.min, tzinfo=_TZ)
+    with appt_session() as db:
+        appts = _active_appointments(db, day_start, day_start + timedelta(days=1))
+    starts = [start for start, _ in appts]
+    # Fin máximo de las citas que empiezan hasta cada posición: un slot se solapa si alguna
+    # cita empieza antes de su fin y la mayor de sus horas de fin queda después de su inicio
+    max_ends = list(accumulate((end for _, end in appts), max))
     available = []
-    db = ApptSession()
-    try:
-        day_start = tz.localize(datetime.combine(date_obj, dtime.min))
-        day_end = tz.localize(datetime.combine(date_obj, dtime.max))
-        appts = db.query(Appointment).filter(
-            Appointment.appointment_date >= day_start,
-            Appointment.appointment_date <= day_end,
-            Appointment.status != AppointmentStatus.CANCELLED
-        ).all()
-        for slot in all_slots:
-            overlap = False
-            for a in appts:
-                a_start = ensure_tz(a.appointment_date)
-                a_end = a_start + timedelta(minutes=a.duration_minutes)
-                if slot['start'] < a_end and slot['end'] > a_start:
-                    overlap = True
-                    break
-            if not overlap:
-                available.append(slot)
-    finally:
-        db.close()
+    for slot in all_slots:
+        k = bisect_left(starts, slot['end'])
+        if not k or max_ends[k - 1] <= slot['start']:
+            available.append(slot)
     return available
 
+_EMAIL_RE = re.compile(r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$")
+
 def valid_email(email: str) -> bool:
     if not email:
         return False
-    pattern = r"^[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}$"
-    return re.match(pattern, email.strip()) is not None
+    return _EMAIL_RE.match(email.strip()) is not None
 
 def build_signed_qr_url(user_email: str, payload: Dict[str, str] | None = None) -> str:
     """Genera una URL única con token HMAC. No requiere DB.
@@ -1661,7 +1809,6 @@ def build_signed_qr_url(user_email: str, payload: Dict[str, str] | None = None)
     # Si no hay secreto, retorna base directamente
     if not QR_SECRET:
         return base
-    import hmac, hashlib, json, time, os, base64
     nonce = base64.urlsafe_b64encode(os.urandom(9)).decode('utf-8').rstrip('=')
     ts = int(time.time())
     payload = payload or {}
@@ -1670,19 +1817,34 @@ def build_signed_qr_url(user_email: str, payload: Dict[str, str] | None = None)
         'ts': ts,
         **{k: v for k, v in payload.items() if v is not None}
     }
-    canonical = json.dumps(data, separators=(',', ':'), sort_keys=True).encode('utf-8')
-    sig = hmac.new(QR_SECRET.encode('utf-8'), canonical, hashlib.sha256).digest()
+    # Compact, sorted, raw UTF-8: the same bytes verify.php re-encodes with JSON_UNESCAPED_UNICODE
+    canonical = orjson.dumps(data, option=orjson.OPT_SORT_KEYS)
+    sig = hmac.digest(_QR_SECRET_BYTES, canonical, 'sha256')
     sig_b64 = base64.urlsafe_b64encode(sig).decode('utf-8').rstrip('=')
     payload_b64 = base64.urlsafe_b64encode(canonical).decode('utf-8').rstrip('=')
     token = f"{sig_b64}.{payload_b64}.{nonce}"
     return f"{base}?t={token}"
 
-def send_email_emailjs(to_email: str, subject: str, body: str, template_params: Dict[str, str] = None) -> bool:
-    """Enviar correo vía microservicio Mailer (PHPMailer). Acepta HTML opcional en template_params['html']."""
+async def send_email_emailjs(to_email: str, subject: str, body: str, template_params: Dict[str, str] = None) -> bool:
+    """Enviar correo vía microservicio Mailer (PHPMailer). Acepta HTML opcional en template_params['html'].
+    Usa el cliente compartido _MAILER, así el envío no bloquea el event loop y reutiliza conexiones.
+    """
+    return await _deliver_mail(to_email, subject, body, template_params) is True
+
+def _mailer_rejected(resp: httpx.Response) -> bool:
+    """True when the mailer refused the request itself (bad payload or address), so nothing was sent."""
+    if 400 <= resp.status_code < 500:
+        return True
+    # PHPMailer validates every To/BCC/Reply-To address before talking to SMTP
+    return 'Invalid address' in resp.text
+
+async def _deliver_mail(to_email: str, subject: str, body: str, template_params: Dict[str, str] = None) -> Optional[bool]:
+    """send_email_emailjs with the outcome spelled out: True sent, False rejected by the mailer (nothing
+    went out), None unknown (network error, timeout or SMTP failure; the mail may have been sent).
+    """
     if not MAILER_URL:
         logger.warning("MAILER_URL no configurado; omitiendo envío de correo")
-        return False
-    import requests
+        return None
     try:
         params = template_params or {}
         # Auto defaults for QR if not provided
@@ -1723,6 +1885,8 @@ def send_email_emailjs(to_email: str, subject: str, body: str, template_params:
         }
         if 'reply_to' in params:
             payload['reply_to'] = params['reply_to']
+        if params.get('bcc'):
+            payload['bcc'] = list(params['bcc'])
         # Optional QR parameters
         if 'qr_url' in params and params['qr_url']:
             payload['qr_url'] = params['qr_url']
@@ -1731,25 +1895,65 @@ def send_email_emailjs(to_email: str, subject: str, body: str, template_params:
         if 'qr_size' in params and params['qr_size']:
             try:
                 payload['qr_size'] = int(params['qr_size'])
-            except Exception:
+            except (TypeError, ValueError):
                 pass
         if 'logo_url' in params and params['logo_url']:
             payload['logo_url'] = params['logo_url']
-        resp = requests.post(MAILER_URL.rstrip('/') + '/', json=payload, timeout=20)
+        resp = await _MAILER.post(MAILER_URL.rstrip('/') + '/', json=payload)
         if resp.status_code == 200:
             try:
                 data = resp.json()
                 if isinstance(data, dict) and data.get('ok') is True:
                     return True
-            except Exception:
+            except ValueError:
                 pass
             logger.error(f"Mailer error body: {resp.text}")
-            return False
+            return None
         logger.error(f"Mailer HTTP {resp.status_code}: {resp.text}")
-        return False
-    except Exception as e:
-        logger.error(f"Error calling Mailer: {e}")
-        return False
+        return False if _mailer_rejected(resp) else None
+    except httpx.HTTPError as e:
+        logger.warning(f"Error calling Mailer: {e}")
+        return None
+
+class PerChatUpdateProcessor(BaseUpdateProcessor):
+    """Run updates of different chats concurrently but each chat's updates one at a time, in arrival order.
+
+    A slow chat (DB work, STT) no longer delays other chats, and a user's quick double tap can't
+    race the ConversationHandler state of their own chat.
+    """
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        # Lock per chat plus how many of its updates are queued or running, to drop idle locks
+        self._chat_locks: Dict[int, asyncio.Lock] = {}
+        self._chat_pending: Dict[int, int] = {}
+
+    async def process_update(self, update: object, coroutine) -> None:
+        # Wait for the chat's turn before taking a global slot: a burst from one chat queues on its
+        # own lock instead of holding the slots every other chat needs
+        chat = update.effective_chat if isinstance(update, Update) else None
+        if chat is None:
+            await super().process_update(update, coroutine)
+            return
+        lock = self._chat_locks.setdefault(chat.id, asyncio.Lock())
+        self._chat_pending[chat.id] = self._chat_pending.get(chat.id, 0) + 1
+        try:
+            async with lock:
+                await super().process_update(update, coroutine)
+        finally:
+            self._chat_pending[chat.id] -= 1
+            if not self._chat_pending[chat.id]:
+                del self._chat_pending[chat.id]
+                del self._chat_locks[chat.id]
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 def main() -> None:
     """Run the bot."""
@@ -1762,8 +1966,12 @@ def main() -> None:
     application = (
         ApplicationBuilder()
         .token(os.getenv('TELEGRAM_BOT_TOKEN'))
-        .rate_limiter(AIORateLimiter())
-        .concurrent_updates(True)
+        # Stay under Telegram's ~30 msg/s global cap and retry 429 (RetryAfter) instead of dropping the reply
+        .rate_limiter(AIORateLimiter(overall_max_rate=25, max_retries=2))
+        # Up to 100 updates in flight, serialized per chat
+        .concurrent_updates(PerChatUpdateProcessor(100))
+        .post_init(start_background_workers)
+        .post_stop(drain_background_tasks)
         .build()
     )
 
@@ -1779,8 +1987,7 @@ def main() -> None:
                 CallbackQueryHandler(show_contact_info, pattern='^contact_info$'),
                 CallbackQueryHandler(show_faq_categories, pattern='^back_to_categories$'),
                 CallbackQueryHandler(back_prev, pattern='^back_prev$'),
-                CallbackQueryHandler(handle_feedback_callback, pattern='^fb_up$'),
-                CallbackQueryHandler(handle_feedback_callback, pattern='^fb_down$'),
+                CallbackQueryHandler(handle_feedback_callback, pattern=r'^fb_(up|down)(:\d+)?$'),
                 CallbackQueryHandler(handle_unknown_callback),
             ],
             SCHEDULE_APPOINTMENT: [
@@ -1,25 +1,22 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Enum, ForeignKey, Text
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, Enum, ForeignKey, Text, Index, text
 from sqlalchemy.orm import declarative_base, sessionmaker, relationship
 from datetime import datetime
 import enum
+import logging
 import os
 from dotenv import load_dotenv
 
+from database.engine import create_missing_indexes, make_engine, make_session_scope
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Engine and session for appointments DB
 APPOINTMENTS_DB_URL = os.getenv('APPOINTMENTS_DB_URL', 'sqlite:///appointments.db')
 
-# For SQLite, enable multi-thread access and pre-ping connections
-connect_args = {}
-if APPOINTMENTS_DB_URL.startswith('sqlite'):
-    connect_args = {"check_same_thread": False}
+engine = make_engine(APPOINTMENTS_DB_URL)
 
-engine = create_engine(
-    APPOINTMENTS_DB_URL,
-    connect_args=connect_args,
-    pool_pre_ping=True,
-)
 SessionLocal = sessionmaker(bind=engine, autocommit=False, autoflush=False, expire_on_commit=False)
 
 Base = declarative_base()
@@ -66,9 +63,20 @@ class Appointment(Base):
 
     user = relationship("User", back_populates="appointments")
 
+    __table_args__ = (
+        # Slot availability filters by status and a date range
+        Index('ix_appt_status_date', 'status', 'appointment_date'),
+        # Un solo turno activo por horario: evita dobles reservas concurrentes del mismo slot
+        Index('uq_appt_active_date', 'appointment_date', unique=True,
+              sqlite_where=text("status != 'CANCELLED'"),
+              postgresql_where=text("status != 'CANCELLED'")),
+    )
+
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # Existing duplicate bookings can block the unique slot index; the bot still re-checks availability
+    create_missing_indexes(engine, Appointment.__table__)
 
 
 def get_db():
@@ -77,3 +85,6 @@ def get_db():
         yield db
     finally:
         db.close()
+
+
+session_scope = make_session_scope(SessionLocal)
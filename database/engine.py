@@ -0,0 +1,85 @@
+from contextlib import contextmanager
+import logging
+
+from sqlalchemy import Table, create_engine, event
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.pool import StaticPool
+
+logger = logging.getLogger(__name__)
+
+
+def make_engine(url: str) -> Engine:
+    """Engine shared by the appointments and questions DBs.
+
+    SQLite gets multi-thread access plus WAL pragmas; server DBs a bounded, recycled pool.
+    Connections are always pre-pinged.
+    """
+    connect_args = {}
+    if url.startswith('sqlite'):
+        connect_args = {"check_same_thread": False}
+        if ':memory:' in url or url == 'sqlite://':
+            # An in-memory DB exists only inside its connection: share that one across threads
+            pool_args = {"poolclass": StaticPool}
+        else:
+            # Handlers hit the DB from several worker threads at once
+            pool_args = {"pool_size": 20}
+    else:
+        pool_args = {"pool_size": 10, "max_overflow": 20, "pool_timeout": 30, "pool_recycle": 1800}
+
+    engine = create_engine(
+        url,
+        connect_args=connect_args,
+        pool_pre_ping=True,
+        query_cache_size=1200,
+        **pool_args,
+    )
+
+    if engine.dialect.name == 'sqlite':
+        @event.listens_for(engine, 'connect')
+        def _sqlite_pragmas(dbapi_conn, _):
+            # WAL lets readers (slot checks, FAQ lookups) run while a write commits; NORMAL is durable enough under WAL
+            cur = dbapi_conn.cursor()
+            cur.execute('PRAGMA journal_mode=WAL')
+            cur.execute('PRAGMA synchronous=NORMAL')
+            cur.execute('PRAGMA temp_store=MEMORY')
+            cur.execute('PRAGMA mmap_size=268435456')
+            cur.execute('PRAGMA cache_size=-64000')
+            # Wait up to 5s for a concurrent writer instead of failing with "database is locked"
+            cur.execute('PRAGMA busy_timeout=5000')
+            cur.close()
+
+    return engine
+
+
+def make_session_scope(session_factory: sessionmaker):
+    """Build a session_scope() context manager for the given session factory."""
+    @contextmanager
+    def session_scope():
+        """Transactional scope: commit on success, rollback on error, always close."""
+        db = session_factory()
+        try:
+            yield db
+            db.commit()
+        except Exception:
+            db.rollback()
+            raise
+        finally:
+            db.close()
+
+    return session_scope
+
+
+def create_missing_indexes(engine: Engine, *tables: Table) -> None:
+    """Create the tables' indexes that don't exist yet.
+
+    create_all skips existing tables, so indexes introduced after the first deploy need this.
+    A unique index that existing rows violate is logged and skipped instead of failing startup.
+    """
+    for table in tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except IntegrityError:
+                logger.warning(f"Could not create index {index.name}: existing rows violate it")
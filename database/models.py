@@ -1,80 +1,28 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Enum, ForeignKey, Text
-from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, relationship
-from datetime import datetime
-import enum
-import os
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
-
-# Create base class for models
-Base = declarative_base()
-
-# Database connection
-DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///authenology_bot.db')
-engine = create_engine(DATABASE_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
+"""Compatibility module: the models live in appointments_db (users, appointments) and questions_db (FAQs, analytics).
 
-# Enums
-class UserType(str, enum.Enum):
-    CUSTOMER = "customer"
-    STAFF = "staff"
-    ADMIN = "admin"
+Re-exported here so old imports keep working, sharing the same engines, sessions and metadata.
+"""
+from sqlalchemy import Column, Integer, String, DateTime, Boolean, ForeignKey, Text
+from sqlalchemy.orm import relationship
+from datetime import datetime
 
-class AppointmentStatus(str, enum.Enum):
-    PENDING = "pending"
-    CONFIRMED = "confirmed"
-    COMPLETED = "completed"
-    CANCELLED = "cancelled"
+from database.appointments_db import (
+    Base,
+    engine,
+    SessionLocal,
+    get_db,
+    UserType,
+    AppointmentStatus,
+    User,
+    Appointment,
+    init_db as init_appointments_db,
+)
+from database.questions_db import FAQ, init_db as init_questions_db, seed_faqs
 
-# Models
-class User(Base):
-    __tablename__ = 'users'
-    
-    id = Column(Integer, primary_key=True, index=True)
-    telegram_id = Column(Integer, unique=True, nullable=False, index=True)
-    username = Column(String(50), nullable=True)
-    first_name = Column(String(100), nullable=False)
-    last_name = Column(String(100), nullable=True)
-    email = Column(String(100), nullable=True)
-    phone = Column(String(20), nullable=True)
-    user_type = Column(Enum(UserType), default=UserType.CUSTOMER)
-    is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    
-    # Relationships
-    appointments = relationship("Appointment", back_populates="user")
-    documents = relationship("Document", back_populates="user")
-
-class Appointment(Base):
-    __tablename__ = 'appointments'
-    
-    id = Column(Integer, primary_key=True, index=True)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
-    google_calendar_event_id = Column(String(100), nullable=True)
-    appointment_date = Column(DateTime, nullable=False)
-    duration_minutes = Column(Integer, default=30)
-    status = Column(Enum(AppointmentStatus), default=AppointmentStatus.PENDING)
-    notes = Column(Text, nullable=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
-    
-    # Relationships
-    user = relationship("User", back_populates="appointments")
 
 class Document(Base):
     __tablename__ = 'documents'
-    
+
     id = Column(Integer, primary_key=True, index=True)
     user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
     file_id = Column(String(255), nullable=False)  # Telegram file_id
@@ -85,45 +33,15 @@ class Document(Base):
     is_signed = Column(Boolean, default=False)
     signature_data = Column(Text, nullable=True)  # JSON string with signature metadata
     created_at = Column(DateTime, default=datetime.utcnow)
-    
-    # Relationships
-    user = relationship("User", back_populates="documents")
 
-class FAQ(Base):
-    __tablename__ = 'faqs'
-    
-    id = Column(Integer, primary_key=True, index=True)
-    question = Column(String(500), nullable=False)
-    answer = Column(Text, nullable=False)
-    category = Column(String(100), nullable=False)
-    is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=datetime.utcnow)
-    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    # Relationships
+    user = relationship("User", backref="documents")
 
 def init_db():
     """Initialize the database with required tables and initial data"""
-    Base.metadata.create_all(bind=engine)
-    
-    # Add initial FAQ data
-    db = SessionLocal()
-    try:
-        # Check if FAQs already exist
-        if not db.query(FAQ).first():
-            faqs = [
-                FAQ(
-                    question="¿Qué es Authenology?",
-                    answer="Authenology es una plataforma venezolana que te permite firmar documentos de manera electrónica y legalmente válida desde cualquier lugar y dispositivo. Nuestro objetivo es simplificar tus trámites, ahorrarte tiempo y reducir el uso de papel.",
-                    category="general"
-                ),
-                # Add more FAQs here...
-            ]
-            db.add_all(faqs)
-            db.commit()
-    except Exception as e:
-        print(f"Error initializing database: {e}")
-        db.rollback()
-    finally:
-        db.close()
+    init_appointments_db()
+    init_questions_db()
+    seed_faqs()
 
 if __name__ == "__main__":
     init_db()
@@ -1,15 +1,26 @@
-from sqlalchemy import create_engine, Column, Integer, String, DateTime, Boolean, Text
+from sqlalchemy import (
+    inspect, text, Column, Integer, SmallInteger, String, DateTime, Boolean, Text,
+    ForeignKey, Index,
+)
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import declarative_base, sessionmaker
 from datetime import datetime
+import logging
 import os
 from dotenv import load_dotenv
 
+from database.engine import create_missing_indexes, make_engine, make_session_scope
+
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Engine and session for questions DB
 QUESTIONS_DB_URL = os.getenv('QUESTIONS_DB_URL', 'sqlite:///questions.db')
-engine = create_engine(QUESTIONS_DB_URL)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+engine = make_engine(QUESTIONS_DB_URL)
+
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, expire_on_commit=False)
 
 Base = declarative_base()
 
@@ -24,11 +35,18 @@ class FAQ(Base):
     created_at = Column(DateTime, default=datetime.utcnow)
     updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
+    __table_args__ = (
+        # FAQ listings filter by category and active flag
+        Index('ix_faq_cat_active', 'category', 'is_active'),
+        # Conflict target for the seed_faqs upsert
+        Index('uq_faq_question', 'question', unique=True),
+    )
+
 class UserQuestion(Base):
     __tablename__ = 'user_questions'
 
     id = Column(Integer, primary_key=True, index=True)
-    telegram_id = Column(Integer, index=True)
+    telegram_id = Column(Integer)
     username = Column(String(50), nullable=True)
     first_name = Column(String(100), nullable=True)
     last_name = Column(String(100), nullable=True)
@@ -37,20 +55,88 @@ class UserQuestion(Base):
     source = Column(String(20), default='text')  # 'text' | 'voice'
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # A user's questions in time order straight from the index (also serves telegram_id lookups)
+        Index('ix_uq_tg_created', 'telegram_id', 'created_at'),
+    )
+
 
 class Feedback(Base):
     __tablename__ = 'feedback'
 
     id = Column(Integer, primary_key=True, index=True)
-    telegram_id = Column(Integer, index=True)
-    value = Column(String(10), nullable=False)  # 'up' | 'down'
-    question_text = Column(Text, nullable=True)
+    telegram_id = Column(Integer)
+    value = Column(SmallInteger, nullable=False)  # 1 = útil, -1 = no útil
+    faq_id = Column(Integer, ForeignKey('faqs.id'), nullable=True, index=True)  # FAQ the vote is about, if any
     message_id = Column(Integer, nullable=True)
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        Index('ix_fb_tg_created', 'telegram_id', 'created_at'),
+    )
+
+
+def _migrate_feedback():
+    """Convert a feedback table still storing 'up'/'down' strings and the question text.
+
+    Votes become 1/-1 and the text is resolved to the FAQ it matches (the lowest id if the
+    question is duplicated). The new faq_id index is created by init_db afterwards.
+    """
+    if 'question_text' not in {c['name'] for c in inspect(engine).get_columns('feedback')}:
+        return
+    faq_lookup = "(SELECT MIN(f.id) FROM faqs f WHERE f.question = {}.question_text)"
+    with engine.begin() as conn:
+        if engine.dialect.name == 'sqlite':
+            # SQLite can't change a column's type: rebuild the table (ids are regenerated)
+            for index in inspect(conn).get_indexes('feedback'):
+                conn.execute(text(f'DROP INDEX {index["name"]}'))
+            conn.execute(text('ALTER TABLE feedback RENAME TO feedback_legacy'))
+            Feedback.__table__.create(bind=conn)
+            conn.execute(text(
+                "INSERT INTO feedback (telegram_id, value, faq_id, message_id, created_at) "
+                "SELECT l.telegram_id, CASE l.value WHEN 'up' THEN 1 ELSE -1 END, "
+                f"{faq_lookup.format('l')}, l.message_id, l.created_at "
+                "FROM feedback_legacy l ORDER BY l.id"
+            ))
+            conn.execute(text('DROP TABLE feedback_legacy'))
+        else:
+            # In place, keeping ids, the primary key and the id sequence
+            conn.execute(text('ALTER TABLE feedback ADD COLUMN faq_id INTEGER REFERENCES faqs (id)'))
+            conn.execute(text(f"UPDATE feedback SET faq_id = {faq_lookup.format('feedback')}"))
+            conn.execute(text(
+                "ALTER TABLE feedback ALTER COLUMN value TYPE SMALLINT "
+                "USING CASE value WHEN 'up' THEN 1 ELSE -1 END"
+            ))
+            conn.execute(text('ALTER TABLE feedback DROP COLUMN question_text'))
+    logger.info("Migrated feedback table to numeric votes and FAQ references")
+
+
+def _dedupe_faqs():
+    """Keep the oldest row (MIN(id)) of each repeated question so uq_faq_question can be created.
+
+    Feedback pointing at a removed duplicate is moved to the kept row first.
+    """
+    keep = "SELECT MIN(id) FROM faqs GROUP BY question"
+    with engine.begin() as conn:
+        if conn.execute(text("SELECT 1 FROM faqs GROUP BY question HAVING COUNT(*) > 1 LIMIT 1")).first() is None:
+            return
+        conn.execute(text(
+            "UPDATE feedback SET faq_id = (SELECT MIN(k.id) FROM faqs k JOIN faqs f ON k.question = f.question "
+            f"WHERE f.id = feedback.faq_id) WHERE faq_id NOT IN ({keep})"
+        ))
+        removed = conn.execute(text(f"DELETE FROM faqs WHERE id NOT IN ({keep})")).rowcount
+    logger.warning(f"Removed {removed} duplicate FAQ rows before creating uq_faq_question")
+
 
 def init_db():
     Base.metadata.create_all(bind=engine)
+    _migrate_feedback()
+    # seed_faqs upserts on the unique question index, which duplicates would block
+    _dedupe_faqs()
+    create_missing_indexes(engine, FAQ.__table__, UserQuestion.__table__, Feedback.__table__)
+
+
+session_scope = make_session_scope(SessionLocal)
 
 
 def seed_faqs():
@@ -58,98 +144,88 @@ def seed_faqs():
 
     If a FAQ with the same question exists, update its answer/category and set active.
     Otherwise, insert it. This lets text edits in the code propagate to DB on startup.
+    Runs as a single INSERT ... ON CONFLICT (question) DO UPDATE statement.
     """
-    db = SessionLocal()
-    try:
-        faqs = [
-            FAQ(
-                question="¿Qué es Authenology?",
-                answer=(
-                    "Authenology es una plataforma venezolana que te permite firmar documentos de manera "
-                    "electrónica y legalmente válida desde cualquier lugar y dispositivo. Nuestro objetivo es "
-                    "simplificar tus trámites, ahorrarte tiempo y reducir el uso de papel."
-                ),
-                category="general",
+    faqs = [
+        dict(
+            question="¿Qué es Authenology?",
+            answer=(
+                "Authenology es una plataforma venezolana que te permite firmar documentos de manera "
+                "electrónica y legalmente válida desde cualquier lugar y dispositivo. Nuestro objetivo es "
+                "simplificar tus trámites, ahorrarte tiempo y reducir el uso de papel."
             ),
-            FAQ(
-                question="¿Cómo puedo empezar a usar Authenology?",
-                answer=(
-                    "Visita nuestro app web regístrate y podrás empezar a firmar en minutos. "
-                    "Ingresa a app.authenology.com.ve desde tu Laptop o PC e incluso desde tu dispositivo movil."
-                ),
-                category="general",
+            category="general",
+        ),
+        dict(
+            question="¿Cómo puedo empezar a usar Authenology?",
+            answer=(
+                "Visita nuestro app web regístrate y podrás empezar a firmar en minutos. "
+                "Ingresa a app.authenology.com.ve desde tu Laptop o PC e incluso desde tu dispositivo movil."
             ),
-            FAQ(
-                question="¿Las firmas electrónicas de Authenology son legales en Venezuela?",
-                answer=(
-                    "Sí. Cumplen con la Ley de Mensajes de Datos y Firmas Electrónicas de Venezuela. "
-                    "Tienen la misma validez legal que una firma manuscrita."
-                ),
-                category="legal",
+            category="general",
+        ),
+        dict(
+            question="¿Las firmas electrónicas de Authenology son legales en Venezuela?",
+            answer=(
+                "Sí. Cumplen con la Ley de Mensajes de Datos y Firmas Electrónicas de Venezuela. "
+                "Tienen la misma validez legal que una firma manuscrita."
             ),
-            FAQ(
-                question="¿Qué tan segura es la plataforma?",
-                answer=(
-                    "Usamos cifrado SSL y múltiples capas de seguridad. Cada firma genera un hash unico que no es capaz alterarse ni rompese "
-                    "y que garantiza la integridad del documento."
-                ),
-                category="tecnico",
+            category="legal",
+        ),
+        dict(
+            question="¿Qué tan segura es la plataforma?",
+            answer=(
+                "Usamos cifrado SSL y múltiples capas de seguridad. Cada firma genera un hash unico que no es capaz alterarse ni rompese "
+                "y que garantiza la integridad del documento."
             ),
-            FAQ(
-                question="¿Cuánto cuesta la firma electrónica?",
-                answer=(
-                    "Persona Natural: $30/año. Profesional Titulado: $36/año. Persona Jurídica: $48/año. "
-                    "Precios más 16% de IVA y sujetos a tasa BCV del día."
-                ),
-                category="facturacion",
+            category="tecnico",
+        ),
+        dict(
+            question="¿Cuánto cuesta la firma electrónica?",
+            answer=(
+                "Persona Natural: $30/año. Profesional Titulado: $36/año. Persona Jurídica: $48/año. "
+                "Precios más 16% de IVA y sujetos a tasa BCV del día."
             ),
-            FAQ(
-                question="¿Cómo firmo un documento desde el aplicativo?",
-                answer=(
-                    "1) Entra a app.authenology.com.ve. 2) Inicia sesión. 3) Ve a 'Firmar'. 4) Carga el PDF. "
-                    "5) Selecciona tu certificado .p12 y coloca tu contraseña. 6) Elige 'QR + Información'. "
-                    "7) Posiciona la firma y presiona 'Firmar'."
-                ),
-                category="uso",
+            category="facturacion",
+        ),
+        dict(
+            question="¿Cómo firmo un documento desde el aplicativo?",
+            answer=(
+                "1) Entra a app.authenology.com.ve. 2) Inicia sesión. 3) Ve a 'Firmar'. 4) Carga el PDF. "
+                "5) Selecciona tu certificado .p12 y coloca tu contraseña. 6) Elige 'QR + Información'. "
+                "7) Posiciona la firma y presiona 'Firmar'."
             ),
-            FAQ(
-                question="¿Dónde y cómo puedo pagar?",
-                answer=(
-                    "Banco de Venezuela: 0102-0105-54-0000616575, AUTHENTICSING C.A., RIF J503240237, Tel 04123379711.\n"
-                    "Banco Nacional de Crédito (BNC): 0191-0098-74-2198344333, AUTHENTICSING, C.A., RIF J503240237, Tel 04141278081."
-                ),
-                category="pagos",
+            category="uso",
+        ),
+        dict(
+            question="¿Dónde y cómo puedo pagar?",
+            answer=(
+                "Banco de Venezuela: 0102-0105-54-0000616575, AUTHENTICSING C.A., RIF J503240237, Tel 04123379711.\n"
+                "Banco Nacional de Crédito (BNC): 0191-0098-74-2198344333, AUTHENTICSING, C.A., RIF J503240237, Tel 04141278081."
             ),
-            FAQ(
-                question="Horario de atención",
-                answer=(
-                    "Lunes a Viernes: 8:00 AM a 5:00 PM."
-                ),
-                category="general",
+            category="pagos",
+        ),
+        dict(
+            question="Horario de atención",
+            answer=(
+                "Lunes a Viernes: 8:00 AM a 5:00 PM."
             ),
-        ]
-
-        # Upsert by question
-        for f in faqs:
-            existing = db.query(FAQ).filter(FAQ.question == f.question).first()
-            if existing:
-                changed = False
-                if existing.answer != f.answer:
-                    existing.answer = f.answer
-                    changed = True
-                if existing.category != f.category:
-                    existing.category = f.category
-                    changed = True
-                if existing.is_active is False:
-                    existing.is_active = True
-                    changed = True
-                if changed:
-                    existing.updated_at = datetime.utcnow()
-            else:
-                db.add(f)
-        db.commit()
-    finally:
-        db.close()
+            category="general",
+        ),
+    ]
+
+    # Upsert by question; only rows whose text/category changed or that were deactivated get touched
+    insert = sqlite.insert if engine.dialect.name == 'sqlite' else postgresql.insert
+    stmt = insert(FAQ).values(faqs)
+    new = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[FAQ.question],
+        set_={'answer': new.answer, 'category': new.category, 'is_active': True, 'updated_at': datetime.utcnow()},
+        where=(FAQ.answer != new.answer) | (FAQ.category != new.category) | (FAQ.is_active == False),
+    )
+    # One transaction on a bare connection: no Session/identity map, a single commit
+    with engine.begin() as conn:
+        conn.execute(stmt)
 
 
 if __name__ == "__main__":
@@ -46,6 +46,12 @@ $message = $data['message'] ?? '';
 $fromEmail = $data['from_email'] ?? getenv('SMTP_FROM') ?: '';
 $fromName = $data['from_name'] ?? getenv('SMTP_FROM_NAME') ?: 'Authenology Bot';
 $replyTo = $data['reply_to'] ?? '';
+// Optional BCC recipients (array or comma-separated string)
+$bcc = $data['bcc'] ?? [];
+if (is_string($bcc)) {
+    $bcc = explode(',', $bcc);
+}
+$bcc = is_array($bcc) ? array_values(array_filter(array_map('trim', array_filter($bcc, 'is_string')))) : [];
 
 // Optional QR parameters
 $qrUrl = $data['qr_url'] ?? '';
@@ -117,6 +123,9 @@ try {
     // Sender/Recipients
     $mail->setFrom($fromEmail, $fromName);
     $mail->addAddress($to);
+    foreach ($bcc as $bccAddr) {
+        $mail->addBCC($bccAddr);
+    }
     if ($replyTo) {
         $mail->addReplyTo($replyTo);
     }
@@ -1,33 +1,58 @@
+import asyncio
 import os
+import threading
+import time
 import pytz
 from datetime import datetime, timedelta
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
 from googleapiclient.discovery import build
-import pickle
+from googleapiclient.errors import HttpError
 from pathlib import Path
 from dotenv import load_dotenv
 
 # Load environment variables
 load_dotenv()
 
-# If modifying these scopes, delete the token.pickle file
+# If modifying these scopes, delete the token.json file
 SCOPES = ['https://www.googleapis.com/auth/calendar']
+TOKEN_FILE = Path('token.json')
+LEGACY_TOKEN_FILE = Path('token.pickle')
+# Seconds to reuse a day's event list before revalidating it with Google (ETag)
+CALENDAR_CACHE_TTL = float(os.getenv('CALENDAR_CACHE_TTL', '30'))
 
 class GoogleCalendarService:
     def __init__(self):
         self.credentials = self._get_credentials()
-        self.service = build('calendar', 'v3', credentials=self.credentials)
+        # Discovery document bundled with google-api-python-client: no HTTP fetch on startup
+        self.service = build('calendar', 'v3', credentials=self.credentials,
+                             static_discovery=True, cache_discovery=False)
         self.calendar_id = os.getenv('GOOGLE_CALENDAR_ID')
         self.timezone = os.getenv('TIMEZONE', 'America/Caracas')
+        self._tz = pytz.timezone(self.timezone)
+        self._business_hours = {
+            'start': int(os.getenv('BUSINESS_HOURS_START', 8)),
+            'end': int(os.getenv('BUSINESS_HOURS_END', 17))
+        }
+        # (calendar_id, timeMin, timeMax) -> (fetched_at, etag, events)
+        self._events_cache = {}
+        # The httplib2 transport behind self.service is not thread-safe: one Google call at a time
+        self._lock = threading.Lock()
+        # Background token refresh, scheduled by start() and cancelled by aclose()
+        self._token_task = None
 
     def _get_credentials(self):
         creds = None
-        # The file token.pickle stores the user's access and refresh tokens
-        if os.path.exists('token.pickle'):
-            with open('token.pickle', 'rb') as token:
+        # The file token.json stores the user's access and refresh tokens
+        if TOKEN_FILE.exists():
+            creds = Credentials.from_authorized_user_file(str(TOKEN_FILE), SCOPES)
+        elif LEGACY_TOKEN_FILE.exists():
+            # Migrate the old pickle token once instead of forcing a new OAuth login
+            import pickle
+            with open(LEGACY_TOKEN_FILE, 'rb') as token:
                 creds = pickle.load(token)
+            self._save_credentials(creds)
         
         # If there are no (valid) credentials available, let the user log in.
         if not creds or not creds.valid:
@@ -38,11 +63,54 @@ class GoogleCalendarService:
                     os.getenv('GOOGLE_CALENDAR_CREDENTIALS'), SCOPES)
                 creds = flow.run_local_server(port=0)
             # Save the credentials for the next run
-            with open('token.pickle', 'wb') as token:
-                pickle.dump(creds, token)
+            self._save_credentials(creds)
         
         return creds
 
+    def _save_credentials(self, creds):
+        TOKEN_FILE.write_text(creds.to_json())
+
+    def _refresh_credentials(self):
+        self.credentials.refresh(Request())
+        self._save_credentials(self.credentials)
+
+    def start(self):
+        """Refresh the OAuth token ahead of expiry when running inside the bot's event loop.
+
+        Without a loop (scripts) this is a no-op and google-auth still refreshes on the request path.
+        """
+        if self._token_task is not None:
+            return
+        try:
+            self._token_task = asyncio.get_running_loop().create_task(self._token_refresher())
+        except RuntimeError:
+            pass
+
+    async def aclose(self):
+        """Cancel the token refresher started by start()"""
+        if self._token_task is None:
+            return
+        self._token_task.cancel()
+        try:
+            await self._token_task
+        except asyncio.CancelledError:
+            pass
+        self._token_task = None
+
+    async def _token_refresher(self):
+        """Refresh the access token 5 minutes before it expires, so no user request pays for it"""
+        while self.credentials.refresh_token:
+            expiry = self.credentials.expiry  # naive UTC, as google-auth stores it
+            # Tokens last an hour; without a known expiry check back in 55 minutes
+            wait = (expiry - timedelta(minutes=5) - datetime.utcnow()).total_seconds() if expiry else 3300
+            if wait > 0:
+                await asyncio.sleep(wait)
+            try:
+                await asyncio.to_thread(self._locked, self._refresh_credentials)
+            except Exception as e:
+                print(f"Error refreshing calendar token: {e}")
+                await asyncio.sleep(60)
+
     def create_appointment(self, summary, start_datetime, end_datetime, description="", attendees=None):
         """Create a new calendar event"""
         event = {
@@ -74,6 +142,7 @@ class GoogleCalendarService:
                 body=event,
                 sendUpdates='all'
             ).execute()
+            self._events_cache.clear()
             return event.get('id')
         except Exception as e:
             print(f"Error creating calendar event: {e}")
@@ -82,62 +151,79 @@ class GoogleCalendarService:
     def get_available_slots(self, date, duration_minutes=30, working_hours=None):
         """Get available time slots for a given date"""
         if working_hours is None:
-            working_hours = {
-                'start': int(os.getenv('BUSINESS_HOURS_START', 8)),
-                'end': int(os.getenv('BUSINESS_HOURS_END', 17))
-            }
+            working_hours = self._business_hours
 
-        # Set the timezone
-        tz = pytz.timezone(self.timezone)
-        
-        # Create datetime objects for the start and end of the day
-        start_dt = datetime.combine(date, datetime.min.time())
-        start_dt = tz.localize(start_dt) + timedelta(hours=working_hours['start'])
-        end_dt = datetime.combine(date, datetime.min.time())
-        end_dt = tz.localize(end_dt) + timedelta(hours=working_hours['end'])
+        # Working day bounds, localized directly at the opening/closing hours
+        start_dt = self._tz.localize(datetime(date.year, date.month, date.day, working_hours['start']))
+        end_dt = self._tz.localize(datetime(date.year, date.month, date.day, working_hours['end']))
         
         # Get existing events for the day
-        events_result = self.service.events().list(
-            calendarId=self.calendar_id,
-            timeMin=start_dt.isoformat(),
-            timeMax=end_dt.isoformat(),
-            singleEvents=True,
-            orderBy='startTime'
-        ).execute()
-        
-        events = events_result.get('items', [])
+        events = self._list_events(start_dt.isoformat(), end_dt.isoformat())
+        # Parse each event once; Google returns them sorted by start (orderBy='startTime')
+        busy = [
+            (datetime.fromisoformat(e['start'].get('dateTime', e['start'].get('date'))),
+             datetime.fromisoformat(e['end'].get('dateTime', e['end'].get('date'))))
+            for e in events
+        ]
         
-        # Generate time slots
+        # Generate time slots in a single pass over slots and events
         time_slots = []
         current_time = start_dt
         slot_duration = timedelta(minutes=duration_minutes)
+        event_idx = 0
         
         while current_time + slot_duration <= end_dt:
             slot_end = current_time + slot_duration
             
-            # Check if the slot is available
-            is_available = True
-            for event in events:
-                event_start = datetime.fromisoformat(event['start'].get('dateTime', event['start'].get('date')))
-                event_end = datetime.fromisoformat(event['end'].get('dateTime', event['end'].get('date')))
-                
-                if (current_time < event_end and slot_end > event_start):
-                    is_available = False
-                    current_time = event_end  # Move to the end of this event
-                    break
+            # Events that ended by now can't block this or any later slot
+            while event_idx < len(busy) and busy[event_idx][1] <= current_time:
+                event_idx += 1
             
-            if is_available:
-                time_slots.append({
-                    'start': current_time,
-                    'end': slot_end
-                })
-                current_time += slot_duration
-            else:
-                # Move to the next possible slot start time
-                current_time += timedelta(minutes=5)
+            if event_idx < len(busy) and busy[event_idx][0] < slot_end:
+                # Busy: next candidate starts when this event ends
+                current_time = busy[event_idx][1]
+                continue
+            
+            time_slots.append({
+                'start': current_time,
+                'end': slot_end
+            })
+            current_time = slot_end
         
         return time_slots
 
+    def _list_events(self, time_min, time_max):
+        """Events in [time_min, time_max], cached for CALENDAR_CACHE_TTL and then revalidated by ETag"""
+        key = (self.calendar_id, time_min, time_max)
+        cached = self._events_cache.get(key)
+        now = time.monotonic()
+        if cached and now - cached[0] < CALENDAR_CACHE_TTL:
+            return cached[2]
+
+        request = self.service.events().list(
+            calendarId=self.calendar_id,
+            timeMin=time_min,
+            timeMax=time_max,
+            singleEvents=True,
+            orderBy='startTime'
+        )
+        if cached and cached[1]:
+            request.headers['If-None-Match'] = cached[1]
+        try:
+            events_result = request.execute()
+        except HttpError as e:
+            if cached and e.resp.status == 304:
+                # Unchanged since the last fetch: Google sends no body
+                self._events_cache[key] = (now, cached[1], cached[2])
+                return cached[2]
+            raise
+
+        events = events_result.get('items', [])
+        if len(self._events_cache) >= 256:
+            self._events_cache.clear()
+        self._events_cache[key] = (now, events_result.get('etag'), events)
+        return events
+
     def cancel_appointment(self, event_id):
         """Cancel a calendar event"""
         try:
@@ -146,6 +232,7 @@ class GoogleCalendarService:
                 eventId=event_id,
                 sendUpdates='all'
             ).execute()
+            self._events_cache.clear()
             return True
         except Exception as e:
             print(f"Error canceling calendar event: {e}")
@@ -161,3 +248,48 @@ class GoogleCalendarService:
         except Exception as e:
             print(f"Error getting event: {e}")
             return None
+
+    # Async wrappers for the bot's handlers: run the blocking Google calls in a worker thread
+    def _locked(self, fn, *args, **kwargs):
+        with self._lock:
+            return fn(*args, **kwargs)
+
+    async def acreate_appointment(self, *args, **kwargs):
+        """Async create_appointment"""
+        return await asyncio.to_thread(self._locked, self.create_appointment, *args, **kwargs)
+
+    async def aget_available_slots(self, *args, **kwargs):
+        """Async get_available_slots"""
+        return await asyncio.to_thread(self._locked, self.get_available_slots, *args, **kwargs)
+
+    async def acancel_appointment(self, event_id):
+        """Async cancel_appointment"""
+        return await asyncio.to_thread(self._locked, self.cancel_appointment, event_id)
+
+    async def aget_event(self, event_id):
+        """Async get_event"""
+        return await asyncio.to_thread(self._locked, self.get_event, event_id)
+
+
+_instance = None
+
+
+def get_calendar_service():
+    """Process-wide GoogleCalendarService, built on first use.
+
+    Called from the bot's event loop it also starts the token refresher; close_calendar_service()
+    (run by the bot's post_stop hook) cancels it.
+    """
+    global _instance
+    if _instance is None:
+        _instance = GoogleCalendarService()
+    _instance.start()
+    return _instance
+
+
+async def close_calendar_service():
+    """Stop the shared service's background work, if it was ever built"""
+    global _instance
+    if _instance is not None:
+        await _instance.aclose()
+        _instance = None
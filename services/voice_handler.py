@@ -1,11 +1,14 @@
+import asyncio
+import io
+import json
 import os
-import tempfile
+import requests
+import soundfile as sf
 import speech_recognition as sr
 from pydub import AudioSegment
 from telegram import Update
 from telegram.ext import ContextTypes
 import logging
-from pathlib import Path
 
 # Configure logging
 logging.basicConfig(
@@ -14,11 +17,25 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Google's speech models are trained on 16 kHz audio; Telegram sends 48 kHz Opus
+SPEECH_SAMPLE_RATE = 16000
+# Same endpoint as speech_recognition's recognize_google. Without GOOGLE_SPEECH_KEY the library
+# call (and its own default key) is used; with it, requests go through the pooled session
+GOOGLE_SPEECH_URL = 'http://www.google.com/speech-api/v2/recognize'
+GOOGLE_SPEECH_KEY = os.getenv('GOOGLE_SPEECH_KEY') or None
+# (connect, read) seconds: a stalled Google response must not pin a worker thread forever
+GOOGLE_SPEECH_TIMEOUT = (3, 15)
+
 class VoiceHandler:
     def __init__(self):
         self.recognizer = sr.Recognizer()
+        # Bounds the library's urlopen call (used without GOOGLE_SPEECH_KEY) like the session's read timeout
+        self.recognizer.operation_timeout = GOOGLE_SPEECH_TIMEOUT[1]
         self.supported_formats = ['.ogg', '.wav', '.mp3', '.m4a']
         self.lang = os.getenv('VOICE_LANG', 'es-VE')  # idioma por defecto Venezuela
+        # Keep-alive connections to Google shared by the transcription threads
+        self._session = requests.Session()
+        self._session.mount('http://', requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=16))
     
     async def process_voice_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
         """Process voice message and return transcribed text"""
@@ -26,57 +43,50 @@ class VoiceHandler:
             # Get voice message file
             voice_file = await context.bot.get_file(update.message.voice.file_id)
             
-            # Create a temporary file to store the voice message
-            with tempfile.NamedTemporaryFile(suffix='.ogg', delete=False) as temp_file:
-                temp_path = Path(temp_file.name)
-            
-            # Download the voice message
-            await voice_file.download_to_drive(custom_path=temp_path)
-            
-            # Convert to WAV format if needed
-            audio_path = self._convert_to_wav(temp_path)
+            # Download the voice message into memory (Telegram voice notes are OGG/Opus)
+            ogg_buf = io.BytesIO()
+            await voice_file.download_to_memory(out=ogg_buf)
+            ogg_buf.seek(0)
             
-            # Transcribe the audio
-            text = self._transcribe_audio(audio_path)
+            # Decode and transcribe in worker threads so other chats keep being served;
+            # libsndfile and the HTTP call release the GIL
+            audio_data = await asyncio.to_thread(self._decode_audio, ogg_buf)
+            text = await asyncio.to_thread(self._transcribe_audio, audio_data)
             logger.info(f"Voice transcript: {text}")
             
-            # Clean up temporary files
-            temp_path.unlink(missing_ok=True)
-            if audio_path != temp_path:
-                audio_path.unlink(missing_ok=True)
-            
             return text
             
         except Exception as e:
             logger.error(f"Error processing voice message: {e}")
             return ""
     
-    def _convert_to_wav(self, audio_path: Path) -> Path:
-        """Convert audio file to WAV format if needed"""
-        if audio_path.suffix.lower() == '.wav':
-            return audio_path
-        
+    def _decode_audio(self, audio: io.BytesIO, fmt: str = 'ogg') -> sr.AudioData:
+        """Decode an in-memory audio buffer to 16-bit mono PCM"""
         try:
-            # Convert to WAV using pydub
-            sound = AudioSegment.from_file(audio_path)
-            wav_path = audio_path.with_suffix('.wav')
-            sound.export(wav_path, format='wav')
-            return wav_path
+            # libsndfile decodes OGG/Opus in-process, no ffmpeg subprocess
+            data, rate = sf.read(audio, dtype='int16')
+            if data.ndim > 1:
+                data = data.mean(axis=1).astype('int16')
+            audio_data = sr.AudioData(data.tobytes(), rate, 2)
         except Exception as e:
-            logger.error(f"Error converting audio to WAV: {e}")
-            return audio_path  # Try with original file if conversion fails
+            logger.warning(f"soundfile could not decode audio, falling back to ffmpeg: {e}")
+            audio.seek(0)
+            # Fallback: pydub (ffmpeg) for formats libsndfile does not support
+            sound = AudioSegment.from_file(audio, format=fmt).set_channels(1).set_sample_width(2)
+            audio_data = sr.AudioData(sound.raw_data, sound.frame_rate, 2)
+        # Downsample before upload: a third of the FLAC payload, same accuracy
+        if audio_data.sample_rate > SPEECH_SAMPLE_RATE:
+            audio_data = sr.AudioData(
+                audio_data.get_raw_data(convert_rate=SPEECH_SAMPLE_RATE), SPEECH_SAMPLE_RATE, 2
+            )
+        return audio_data
     
-    def _transcribe_audio(self, audio_path: Path) -> str:
-        """Transcribe audio file to text using Google Speech Recognition"""
+    def _transcribe_audio(self, audio_data: sr.AudioData) -> str:
+        """Transcribe PCM audio to text using Google Speech Recognition"""
         try:
-            with sr.AudioFile(str(audio_path)) as source:
-                # Listen for the data (load audio to memory)
-                # Ajuste de ruido ambiente para mejorar precisión
-                self.recognizer.adjust_for_ambient_noise(source, duration=0.2)
-                audio_data = self.recognizer.record(source)
-                # Recognize (convert from speech to text)
-                text = self.recognizer.recognize_google(audio_data, language=self.lang)
-                return text
+            # Recognize (convert from speech to text)
+            text = self._recognize_google(audio_data)
+            return text
         except sr.UnknownValueError:
             logger.warning("Speech Recognition could not understand audio")
             return ""
@@ -87,6 +97,44 @@ class VoiceHandler:
             logger.error(f"Error in speech recognition: {e}")
             return ""
     
+    def _recognize_google(self, audio_data: sr.AudioData) -> str:
+        """Recognizer.recognize_google over a pooled session instead of a new urllib connection per call"""
+        if GOOGLE_SPEECH_KEY is None:
+            return self.recognizer.recognize_google(audio_data, key=None, language=self.lang)
+        flac_data = audio_data.get_flac_data(convert_width=2)
+        try:
+            response = self._session.post(
+                GOOGLE_SPEECH_URL,
+                params={'client': 'chromium', 'lang': self.lang, 'key': GOOGLE_SPEECH_KEY, 'pFilter': 0},
+                data=flac_data,
+                headers={'Content-Type': f'audio/x-flac; rate={audio_data.sample_rate}'},
+                timeout=GOOGLE_SPEECH_TIMEOUT,
+            )
+            response.raise_for_status()
+        except requests.RequestException as e:
+            raise sr.RequestError(f"recognition request failed: {e}")
+        
+        # ignore any blank blocks
+        result = {}
+        for line in response.text.split('\n'):
+            if not line:
+                continue
+            alternatives = json.loads(line)['result']
+            if alternatives:
+                result = alternatives[0]
+                break
+        
+        alternatives = result.get('alternative') or []
+        if not alternatives:
+            raise sr.UnknownValueError()
+        if 'confidence' in alternatives[0]:
+            best = max(alternatives, key=lambda alt: alt.get('confidence', 0))
+        else:
+            best = alternatives[0]
+        if 'transcript' not in best:
+            raise sr.UnknownValueError()
+        return best['transcript']
+    
     async def handle_voice_message(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Handle incoming voice messages"""
         if not update.message.voice: